@@ -0,0 +1,108 @@
+"""
+Bytes fetched by ``iter_download`` for chunk sizes and strides which are not multiples of 4KB.
+
+Compares carrying the unused tail of fetched data over to the next chunk to
+rewinding the request offset and fetching the tail again (as it was done
+before). Requests are answered from memory, only their volume is counted.
+
+    python benchmarks/download_transfer.py
+"""
+
+import argparse
+import asyncio
+import logging
+from collections import defaultdict
+
+from telethon.tl import types
+
+from telethon_asyncpg.client.downloads import MIN_CHUNK_SIZE, _GenericDownloadIter
+
+# (chunk_size, stride), offsets are not aligned either
+CASES = ((1000, 1000), (5000, 5000), (10_000, 10_000), (100_000, 100_000), (3000, 7000), (50_000, 70_000))
+
+
+class RefetchingDownloadIter(_GenericDownloadIter):
+    # loading as it was done before the carry-over
+    async def _load_next_chunk(self, mask=MIN_CHUNK_SIZE - 1):
+        data = b''
+        bad = self.request.offset & mask
+        before = self.request.offset
+        self.request.offset -= bad
+
+        done = False
+        while not done and len(data) - bad < self._chunk_size:
+            cur = await self._request()
+            self.request.offset += self.request.limit
+            data += cur
+            done = len(cur) < self.request.limit
+
+        self.request.offset = before
+        mem = memoryview(data)
+        for i in range(bad, len(data), self._stride):
+            self.buffer.append(mem[i:i + self._chunk_size])
+            self.request.offset += self._stride
+
+        if done:
+            self.left = len(self.buffer)
+            await self.close()
+            return
+
+        if len(self.buffer[-1]) != self._chunk_size:
+            self.buffer.pop()
+            self.request.offset -= self._stride
+
+
+class Session:
+    dc_id = 2
+
+
+class Client:
+    def __init__(self, data: bytes):
+        self.data = data
+        self.session = Session()
+        self._sender = object()
+        self._log = defaultdict(lambda: logging.getLogger(__name__))
+        self.requests = self.fetched = 0
+
+    async def _call(self, sender, request):
+        part = self.data[request.offset:request.offset + request.limit]
+        self.requests += 1
+        self.fetched += len(part)
+        return types.upload.File(types.storage.FileUnknown(), 0, part)
+
+
+async def fetch(cls, data: bytes, chunk_size: int, stride: int, request_size: int):
+    client = Client(data)
+    downloaded = 0
+    async for chunk in cls(
+        client, None, file=types.InputDocumentFileLocation(1, 2, b"", ""), dc_id=None,
+        offset=123, stride=stride, chunk_size=chunk_size, request_size=request_size, file_size=None,
+    ):
+        downloaded += len(chunk)
+    return downloaded, client.requests, client.fetched
+
+
+async def main(size: int, request_size: int) -> None:
+    data = bytes(size)
+    print(f"{size / 2 ** 20:.0f}MB file, requests of {request_size // 1024}KB")
+    print(f"{'chunk':>8}{'stride':>8}{'yielded MB':>12}"
+          f"{'requests before':>17}{'MB before':>11}{'requests after':>16}{'MB after':>10}")
+    for chunk_size, stride in CASES:
+        downloaded, requests_before, fetched_before = await fetch(
+            RefetchingDownloadIter, data, chunk_size, stride, request_size
+        )
+        downloaded_after, requests_after, fetched_after = await fetch(
+            _GenericDownloadIter, data, chunk_size, stride, request_size
+        )
+        assert downloaded == downloaded_after
+        print(f"{chunk_size:>8}{stride:>8}{downloaded / 2 ** 20:>12.1f}"
+              f"{requests_before:>17}{fetched_before / 2 ** 20:>11.1f}"
+              f"{requests_after:>16}{fetched_after / 2 ** 20:>10.1f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size", type=int, default=16 * 2 ** 20)
+    parser.add_argument("--request-size", type=int, default=128 * 1024)
+    args = parser.parse_args()
+    asyncio.get_event_loop().run_until_complete(main(args.size, args.request_size))
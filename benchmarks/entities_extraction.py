@@ -0,0 +1,78 @@
+"""
+Throughput of extracting entity rows from large updates.
+
+Compares the generic per-entity path (``_entity_to_row`` for every entity,
+as it was done before) to class dispatched ``_entities_to_rows`` on updates
+with users, chats and channels, a share of which are repeated.
+
+    python benchmarks/entities_extraction.py
+"""
+
+import argparse
+import random
+import time
+
+from telethon.tl import types
+
+from telethon_asyncpg.sessions import AsyncpgSession
+
+
+def update(users: int, chats: int, repeated: float) -> types.Updates:
+    photo = types.ChatPhotoEmpty()
+    user_list = [
+        types.User(
+            id=n, access_hash=n * 7, first_name=f"User {n}", last_name="Last" if n % 4 else None,
+            username=f"User{n}" if n % 2 else None, phone=str(79000000000 + n) if n % 3 else None,
+            min=n % 10 == 0,
+        )
+        for n in range(1, users + 1)
+    ]
+    chat_list = [
+        types.Channel(n, title=f"Channel {n}", photo=photo, date=None, version=0, access_hash=n * 3)
+        if n % 2 else
+        types.Chat(n, title=f"Chat {n}", photo=photo, participants_count=1, date=None, version=1)
+        for n in range(1, chats + 1)
+    ]
+    user_list += random.choices(user_list, k=int(users * repeated))
+    chat_list += random.choices(chat_list, k=int(chats * repeated))
+    return types.Updates(updates=[], users=user_list, chats=chat_list, date=None, seq=0)
+
+
+def generic(session: AsyncpgSession, tlo: types.Updates):
+    rows = []
+    for e in (*tlo.chats, *tlo.users):
+        row = session._entity_to_row(e)
+        if row:
+            rows.append(row)
+    return rows
+
+
+def dispatched(session: AsyncpgSession, tlo: types.Updates):
+    return session._entities_to_rows(tlo)
+
+
+def main(users: int, chats: int, repeated: float, rounds: int) -> None:
+    session = AsyncpgSession(None, lambda: "bench")
+    tlo = update(users, chats, repeated)
+    entities = len(tlo.users) + len(tlo.chats)
+
+    print(f"{entities} entities, {repeated:.0%} repeated")
+    print(f"{'':<12}{'rows':>8}{'best ms':>10}{'entities/s':>14}")
+    for name, extract in (("generic", generic), ("dispatched", dispatched)):
+        timings = []
+        for _ in range(rounds):
+            started = time.perf_counter()
+            rows = extract(session, tlo)
+            timings.append(time.perf_counter() - started)
+        best = min(timings)
+        print(f"{name:<12}{len(rows):>8}{best * 1000:>10.2f}{entities / best:>14.0f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--chats", type=int, default=1_000)
+    parser.add_argument("--repeated", type=float, default=0.2)
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+    main(args.users, args.chats, args.repeated, args.rounds)
@@ -0,0 +1,93 @@
+"""
+Event loop lag while a huge result (e.g. participants dump) is processed.
+
+A ticker task sleeps 1 ms in a loop and records how late it wakes up while
+``process_entities`` handles results of ``--users`` users, with entity
+extraction done on the loop and offloaded to executor. Another task processes
+one user results meanwhile, like other RPC results would be, and records how
+long each of them takes.
+
+    python benchmarks/entities_loop_lag.py
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+
+from telethon.tl import types
+
+from telethon_asyncpg.sessions import AsyncpgSession
+
+TICK = 0.001
+
+
+def participants(count: int) -> types.channels.ChannelParticipants:
+    users = [
+        types.User(id=n, access_hash=n * 7, first_name=f"User {n}", username=f"user{n}")
+        for n in range(1, count + 1)
+    ]
+    return types.channels.ChannelParticipants(count=count, participants=[], users=users)
+
+
+async def ticker(lags: list, stop: asyncio.Event) -> None:
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(TICK)
+        lags.append(time.perf_counter() - started - TICK)
+
+
+async def handler(session: AsyncpgSession, latencies: list, stop: asyncio.Event) -> None:
+    user = types.User(id=0, access_hash=0, first_name="Other")
+    while not stop.is_set():
+        started = time.perf_counter()
+        await session.process_entities([user])
+        latencies.append(time.perf_counter() - started)
+        await asyncio.sleep(TICK)
+
+
+async def measure(threshold, tlo, results: int):
+    # no flush happens during the run, pool is never touched
+    session = AsyncpgSession(
+        None, lambda: "bench", entity_offload_threshold=threshold,
+        entity_flush_size=10 ** 9, entity_flush_interval=3600, fingerprint_cache_size=0,
+    )
+    lags, latencies, stop = [], [], asyncio.Event()
+    tasks = [
+        asyncio.ensure_future(ticker(lags, stop)),
+        asyncio.ensure_future(handler(session, latencies, stop)),
+    ]
+    await asyncio.sleep(0.05)
+
+    started = time.perf_counter()
+    for _ in range(results):
+        await session.process_entities(tlo)
+        session._entity_buffer.drain()
+    elapsed = time.perf_counter() - started
+
+    stop.set()
+    await asyncio.gather(*tasks)
+    if session._flush_handle is not None:
+        session._flush_handle.cancel()
+    lags.sort()
+    return elapsed, statistics.median(lags), lags[int(len(lags) * 0.99)], lags[-1], max(latencies)
+
+
+async def main(users: int, results: int, threshold: int) -> None:
+    tlo = participants(users)
+    print(f"{results} results of {users} users")
+    print(f"{'':<12}{'total ms':>10}{'lag p50 ms':>12}{'lag p99 ms':>12}{'lag max ms':>12}"
+          f"{'other max ms':>14}")
+    for name, value in (("on loop", None), ("offloaded", threshold)):
+        elapsed, p50, p99, worst, other = await measure(value, tlo, results)
+        print(f"{name:<12}{elapsed * 1000:>10.1f}{p50 * 1000:>12.2f}{p99 * 1000:>12.2f}{worst * 1000:>12.2f}"
+              f"{other * 1000:>14.2f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=50_000)
+    parser.add_argument("--results", type=int, default=5)
+    parser.add_argument("--threshold", type=int, default=5000)
+    args = parser.parse_args()
+    asyncio.get_event_loop().run_until_complete(main(args.users, args.results, args.threshold))
@@ -0,0 +1,119 @@
+"""
+Allocations of turning a 10k users ``GetParticipants`` result into entity rows.
+
+Compares the row path as it was before ``EntityRow``, (id, hash, username,
+phone, name) tuples built through ``get_input_peer`` which are rebuilt for
+the phone and copied into lists with session_id inserted, to building
+``EntityRow`` once in parameter order.
+
+    python benchmarks/entities_rows.py
+"""
+
+import argparse
+import time
+import tracemalloc
+
+from telethon import utils
+from telethon.tl import types
+
+from telethon_asyncpg.sessions import AsyncpgSession
+
+
+def participants(count: int) -> types.channels.ChannelParticipants:
+    users = [
+        types.User(
+            id=n, access_hash=n * 7, first_name=f"User {n}",
+            username=f"user{n}" if n % 2 else None, phone=str(79000000000 + n) if n % 3 else None,
+        )
+        for n in range(1, count + 1)
+    ]
+    return types.channels.ChannelParticipants(
+        count=count,
+        participants=[types.ChannelParticipant(user_id=user.id, date=None) for user in users],
+        users=users,
+    )
+
+
+def tuple_row(entity):
+    # ``BaseAsyncSession._entity_to_row`` as it was before EntityRow
+    if not isinstance(entity, types.TLObject):
+        return
+    try:
+        peer = utils.get_input_peer(entity, allow_self=False)
+        marked_id = utils.get_peer_id(peer)
+    except TypeError:
+        return
+
+    if isinstance(peer, (types.InputPeerUser, types.InputPeerChannel)):
+        peer_hash = peer.access_hash
+    elif isinstance(peer, types.InputPeerChat):
+        peer_hash = 0
+    else:
+        return
+
+    username = getattr(entity, 'username', None) or None
+    if username is not None:
+        username = username.lower()
+    phone = getattr(entity, 'phone', None)
+    name = utils.get_display_name(entity) or None
+    return marked_id, peer_hash, username, phone, name
+
+
+def tuples_then_lists(session: AsyncpgSession, tlo):
+    rows = []
+    for entity in session._collect_entities(tlo):
+        row = tuple_row(entity)
+        if row:
+            rows.append(row)
+    for n, row in enumerate(rows):
+        if row[3]:
+            row = (*row[:3], int(row[3]), row[4])
+            rows[n] = row
+    for n, row in enumerate(rows):
+        row = list(row)
+        row.insert(0, session._session_id)
+        rows[n] = row
+    return rows
+
+
+def entity_rows(session: AsyncpgSession, tlo):
+    return session._entities_to_rows(tlo)
+
+
+def measure(build, session, tlo, rounds: int):
+    tracemalloc.start()
+    started = tracemalloc.take_snapshot()
+    rows = build(session, tlo)
+    finished = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    stats = finished.compare_to(started, "filename")
+    blocks = sum(stat.count_diff for stat in stats)
+    retained = sum(stat.size_diff for stat in stats)
+    del rows
+
+    timings = []
+    for _ in range(rounds):
+        begin = time.perf_counter()
+        build(session, tlo)
+        timings.append(time.perf_counter() - begin)
+    return blocks, retained, peak, min(timings)
+
+
+def main(count: int, rounds: int) -> None:
+    tlo = participants(count)
+
+    print(f"{'':<20}{'blocks':>10}{'retained KiB':>14}{'peak KiB':>10}{'best ms':>10}")
+    session = AsyncpgSession(None, lambda: "bench")
+    for name, build in (("tuples then lists", tuples_then_lists), ("EntityRow", entity_rows)):
+        blocks, retained, peak, best = measure(build, session, tlo, rounds)
+        print(f"{name:<20}{blocks:>10}{retained / 1024:>14.1f}{peak / 1024:>10.1f}{best * 1000:>10.2f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+    main(args.users, args.rounds)
@@ -1,4 +1,5 @@
 from .sessions.asyncpg import AsyncpgSession
+from .sessions.manager import SessionManager
 
 __telethon_version__ = '1.13.0'
 __version__ = "0.1.0"
@@ -48,11 +48,17 @@ try:
     A, B = do_import("telethon.client.downloads", "_DirectDownloadIter", B_REPLACE)
     patch(A, B, "_init")
 
+    A, B = do_import("telethon.client.downloads", "DownloadMethods", B_REPLACE)
+    patch(A, B, "download_file", "iter_download")
+
     A, B = do_import("telethon.client.telegrambaseclient", "TelegramBaseClient", B_REPLACE)
-    patch(A, B, "__init__", "connect", "_disconnect", "_switch_dc", "_auth_key_callback")
+    patch(A, B, "__init__", "connect", "_disconnect", "_disconnect_coro", "_switch_dc", "_auth_key_callback")
 
     A, B = do_import("telethon.client.updates", "UpdateMethods", B_REPLACE)
-    patch(A, B, "_handle_update", "_update_loop", "_dispatch_update")
+    patch(
+        A, B, "_handle_update", "_update_loop", "_dispatch_update", "catch_up",
+        "_schedule_state_checkpoint", "_save_update_states",
+    )
 
     A, B = do_import("telethon.client.users", "UserMethods", B_REPLACE)
     patch(A, B, "_call", "get_input_entity", )
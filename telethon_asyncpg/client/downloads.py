@@ -1,9 +1,12 @@
+import asyncio
+import collections
 import datetime
 import io
 import os
 import pathlib
 import typing
 import inspect
+import mmap
 
 from telethon.crypto import AES
 
@@ -25,6 +28,8 @@ MAX_CHUNK_SIZE = 512 * 1024
 
 
 class _DirectDownloadIter(RequestIter):
+    _sender = None
+
     async def _init(
             self, file, dc_id, offset, stride, chunk_size, request_size, file_size
     ):
@@ -34,7 +39,6 @@ class _DirectDownloadIter(RequestIter):
         self.total = file_size
         self._stride = stride
         self._chunk_size = chunk_size
-        self._last_part = None
 
         self._exported = dc_id and self.client.session.dc_id != dc_id
         if not self._exported:
@@ -66,9 +70,9 @@ class _DirectDownloadIter(RequestIter):
         else:
             self.request.offset += self._stride
 
-    async def _request(self):
+    async def _request(self, request=None):
         try:
-            result = await self.client._call(self._sender, self.request)
+            result = await self.client._call(self._sender, request or self.request)
             if isinstance(result, types.upload.FileCdnRedirect):
                 raise NotImplementedError  # TODO Implement
             else:
@@ -78,7 +82,7 @@ class _DirectDownloadIter(RequestIter):
             self.client._log[__name__].info('File lives in another DC')
             self._sender = await self.client._borrow_exported_sender(e.new_dc)
             self._exported = True
-            return await self._request()
+            return await self._request(request)
 
     async def close(self):
         if not self._sender:
@@ -102,17 +106,89 @@ class _DirectDownloadIter(RequestIter):
     __exit__ = helpers._sync_exit
 
 
+class _ParallelDownloadIter(_DirectDownloadIter):
+    """
+    Direct download which keeps up to ``parallel`` requests in flight on the
+    sender of file's DC, chunks are yielded in order nevertheless.
+    """
+    _pending = ()
+
+    async def _init(
+            self, file, dc_id, offset, stride, chunk_size, request_size, file_size, parallel
+    ):
+        await super()._init(
+            file, dc_id, offset, stride, chunk_size, request_size, file_size)
+        self._parallel = parallel
+        self._pending = collections.deque()
+        # chunks requested so far, never more than ``limit``
+        self._requested = 0
+
+    async def _load_next_chunk(self):
+        if not self._requested:
+            # The first request finds out DC of the file (``FileMigrateError``),
+            # so the sender is never switched under concurrent requests.
+            self._requested = 1
+            return await super()._load_next_chunk()
+
+        self._request_ahead()
+        if not self._pending:
+            # Size is known and every chunk is already yielded
+            await self.close()
+            return
+
+        try:
+            cur = await self._pending.popleft()
+        except BaseException:
+            await self.close()
+            raise
+
+        self.buffer.append(cur)
+        if len(cur) < self.request.limit:
+            self.left = len(self.buffer)
+            await self.close()
+
+    def _request_ahead(self):
+        while len(self._pending) < self._parallel and self._requested < self.limit:
+            if self.total is not None and self.request.offset >= self.total:
+                break
+
+            request = functions.upload.GetFileRequest(
+                self.request.location, offset=self.request.offset, limit=self.request.limit)
+            self._pending.append(asyncio.ensure_future(self._request(request)))
+            self._requested += 1
+            self.request.offset += self._stride
+
+    async def close(self):
+        pending, self._pending = self._pending, collections.deque()
+        for future in pending:
+            future.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+        await super().close()
+
+
 class _GenericDownloadIter(_DirectDownloadIter):
+    async def _init(self, **kwargs):
+        await super()._init(**kwargs)
+        # Offset of the next chunk to yield, ``request.offset`` is where
+        # the next request will fetch from
+        self._offset = self.request.offset
+        # Fetched data which was not yielded yet, it starts at ``_offset``
+        self._carry = b''
+
     async def _load_next_chunk(self, mask=MIN_CHUNK_SIZE - 1):
         # 1. Fetch enough for one chunk
-        data = b''
+        #    ``bytearray`` grows in place, ``bytes`` would be copied every time
+        data = bytearray(self._carry)
 
         # 1.1. ``bad`` is how much into the data we have we need to offset
-        bad = self.request.offset & mask
-        before = self.request.offset
-
-        # 1.2. We have to fetch from a valid offset, so remove that bad part
-        self.request.offset -= bad
+        if data:
+            # Continue right after the data carried over
+            bad = 0
+        else:
+            # 1.2. We have to fetch from a valid offset, so remove that bad part
+            bad = self._offset & mask
+            self.request.offset = self._offset - bad
 
         done = False
         while not done and len(data) - bad < self._chunk_size:
@@ -122,20 +198,20 @@ class _GenericDownloadIter(_DirectDownloadIter):
             data += cur
             done = len(cur) < self.request.limit
 
-        # 1.3 Restore our last desired offset
-        self.request.offset = before
-
         # 2. Fill the buffer with the data we have
         # 2.1. Slicing `bytes` is expensive, yield `memoryview` instead
         mem = memoryview(data)
 
         # 2.2. The current chunk starts at ``bad`` offset into the data,
-        #      and each new chunk is ``stride`` bytes apart of the other
-        for i in range(bad, len(data), self._stride):
+        #      and each new chunk is ``stride`` bytes apart of the other.
+        #      Incomplete chunks are only returned at the end of the file.
+        i = bad
+        while i + self._chunk_size <= len(data) or (done and i < len(data)):
             self.buffer.append(mem[i:i + self._chunk_size])
 
             # 2.3. We will yield this offset, so move to the next one
-            self.request.offset += self._stride
+            i += self._stride
+            self._offset += self._stride
 
         # 2.4. If we are in the last chunk, we will return the last partial data
         if done:
@@ -143,14 +219,59 @@ class _GenericDownloadIter(_DirectDownloadIter):
             await self.close()
             return
 
-        # 2.5. If we are not done, we can't return incomplete chunks.
-        if len(self.buffer[-1]) != self._chunk_size:
-            self._last_part = self.buffer.pop().tobytes()
+        # 3. Keep the rest for the next chunk instead of fetching it again.
+        #    With ``stride`` bigger than the data the next chunk starts
+        #    past it, and nothing is carried over.
+        self._carry = mem[i:]
 
-            # 3. Be careful with the offsets. Re-fetching a bit of data
-            #    is fine, since it greatly simplifies things.
-            # TODO Try to not re-fetch data
-            self.request.offset -= self._stride
+
+class _MappedFile:
+    """
+    Output file preallocated to the expected size and written through
+    ``mmap``, every part is copied straight into its place. Data beyond
+    the expected size is appended with plain writes.
+    """
+    def __init__(self, path, size):
+        self._file = open(path, 'w+b')
+        try:
+            self._file.truncate(size)
+            self._map = mmap.mmap(self._file.fileno(), size)
+        except BaseException:
+            self._file.close()
+            raise
+        self._pos = 0
+
+    def write(self, data):
+        end = self._pos + len(data)
+        if self._map is not None and end <= len(self._map):
+            self._map[self._pos:end] = data
+        else:
+            self._unmap()
+            self._file.seek(self._pos)
+            self._file.write(data)
+        self._pos = end
+        return len(data)
+
+    def tell(self):
+        return self._pos
+
+    def flush(self):
+        if self._map is not None:
+            self._map.flush()
+        self._file.flush()
+
+    def _unmap(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def close(self):
+        try:
+            self._unmap()
+            # The expected size may be bigger than the real one
+            self._file.truncate(self._pos)
+        finally:
+            self._file.close()
 
 
 class DownloadMethods:
@@ -379,7 +500,8 @@ class DownloadMethods:
             progress_callback: 'hints.ProgressCallback' = None,
             dc_id: int = None,
             key: bytes = None,
-            iv: bytes = None) -> typing.Optional[bytes]:
+            iv: bytes = None,
+            parallel: int = 1) -> typing.Optional[bytes]:
         """
         Low-level method to download files from their input location.
 
@@ -407,7 +529,9 @@ class DownloadMethods:
 
             file_size (`int`, optional):
                 The file size that is about to be downloaded, if known.
-                Only used if ``progress_callback`` is specified.
+                Files written by path are preallocated to this size and
+                written through ``mmap``. Taken from the input location
+                when possible.
 
             progress_callback (`callable`, optional):
                 A callback function accepting two parameters:
@@ -424,6 +548,11 @@ class DownloadMethods:
             iv ('bytes', optional):
                 In case of an encrypted upload (secret chats) an iv is supplied
 
+            parallel (`int`, optional):
+                How many parts may be requested at once. Parts are still
+                written in order. Several requests in flight multiply
+                throughput of large files on high-latency links.
+
 
         Example
             .. code-block:: python
@@ -443,30 +572,40 @@ class DownloadMethods:
             raise ValueError(
                 'The part size must be evenly divisible by 4096.')
 
+        if file_size is None:
+            file_size = utils._get_file_info(input_location).size
+
         in_memory = file is None or file is bytes
         if in_memory:
+            # ``getvalue`` hands the buffer over without copying it
             f = io.BytesIO()
         elif isinstance(file, str):
             # Ensure that we'll be able to download the media
             helpers.ensure_parent_dir_exists(file)
-            f = open(file, 'wb')
+            if file_size:
+                f = _MappedFile(file, file_size)
+            else:
+                f = open(file, 'wb')
         else:
             f = file
 
         try:
-            async for chunk in self.iter_download(
-                    input_location, request_size=part_size, dc_id=dc_id):
-                if iv and key:
-                    chunk = AES.decrypt_ige(chunk, key, iv)
-                r = f.write(chunk)
-                if inspect.isawaitable(r):
-                    await r
-
-                if progress_callback:
-                    r = progress_callback(f.tell(), file_size)
+            # Requests still in flight are cancelled if writing fails
+            async with self.iter_download(
+                    input_location, request_size=part_size, dc_id=dc_id,
+                    parallel=parallel) as stream:
+                async for chunk in stream:
+                    if iv and key:
+                        chunk = AES.decrypt_ige(chunk, key, iv)
+                    r = f.write(chunk)
                     if inspect.isawaitable(r):
                         await r
 
+                    if progress_callback:
+                        r = progress_callback(f.tell(), file_size)
+                        if inspect.isawaitable(r):
+                            await r
+
             # Not all IO objects have flush (see #1227)
             if callable(getattr(f, 'flush', None)):
                 f.flush()
@@ -487,7 +626,8 @@ class DownloadMethods:
             chunk_size: int = None,
             request_size: int = MAX_CHUNK_SIZE,
             file_size: int = None,
-            dc_id: int = None
+            dc_id: int = None,
+            parallel: int = 1
     ):
         """
         Iterates over a file download, yielding chunks of the file.
@@ -548,6 +688,11 @@ class DownloadMethods:
                 The data center the library should connect to in order
                 to download the file. You shouldn't worry about this.
 
+            parallel (`int`, optional):
+                How many chunks may be requested at once, chunks are
+                yielded in order anyway. Only used by direct downloads
+                (see the note above).
+
         Yields
 
             `bytes` objects representing the chunks of the file if the
@@ -605,7 +750,17 @@ class DownloadMethods:
         elif request_size > MAX_CHUNK_SIZE:
             request_size = MAX_CHUNK_SIZE
 
+        kwargs = {}
         if chunk_size == request_size \
+                and offset % MIN_CHUNK_SIZE == 0 \
+                and stride % MIN_CHUNK_SIZE == 0 \
+                and parallel > 1:
+            cls = _ParallelDownloadIter
+            kwargs['parallel'] = parallel
+            self._log[__name__].info('Starting parallel file download in chunks of '
+                                     '%d at %d, stride %d, %d at once',
+                                     request_size, offset, stride, parallel)
+        elif chunk_size == request_size \
                 and offset % MIN_CHUNK_SIZE == 0 \
                 and stride % MIN_CHUNK_SIZE == 0:
             cls = _DirectDownloadIter
@@ -625,7 +780,8 @@ class DownloadMethods:
             stride=stride,
             chunk_size=chunk_size,
             request_size=request_size,
-            file_size=file_size
+            file_size=file_size,
+            **kwargs
         )
 
     # endregion
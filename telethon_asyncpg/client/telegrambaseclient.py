@@ -333,6 +333,7 @@ class TelegramBaseClient(abc.ABC):
         self._borrow_sender_lock = asyncio.Lock(loop=self._loop)
 
         self._updates_handle = None
+        self._state_checkpoint = None
         self._last_request = time.time()
         self._channel_pts = {}
 
@@ -348,11 +349,13 @@ class TelegramBaseClient(abc.ABC):
         self._authorized = None  # None = unknown, False = no, True = yes
 
         # Update state (for catching up after a disconnection)
-        # TODO Get state from channels too
         async def __set_state_cache(*args, **kwargs):  # hack :C
-            setattr(self, "_state_cache", StateCache(
-                await self.session.get_update_state(0), self._log
-            ))
+            # One query for the general state and all the channels
+            states = await self.session.get_all_update_states()
+            state_cache = StateCache(states.pop(0, None), self._log)
+            for channel_id, state in states.items():
+                state_cache[channel_id] = state.pts
+            setattr(self, "_state_cache", state_cache)
         settings[__set_state_cache] = (), {}
 
         # Some further state for subclasses
@@ -461,8 +464,8 @@ class TelegramBaseClient(abc.ABC):
             # We don't want to init or modify anything if we were already connected
             return
 
-        await self.session.set_auth_key(self._sender.auth_key)
-        await self.session.save()
+        async with self.session.transaction():
+            await self.session.set_auth_key(self._sender.auth_key)
 
         await self._sender.send(self._init_with(
             functions.help.GetConfigRequest()))
@@ -532,16 +535,11 @@ class TelegramBaseClient(abc.ABC):
             await asyncio.wait(self._updates_queue, loop=self._loop)
             self._updates_queue.clear()
 
-        pts, date = self._state_cache[None]
-        if pts and date:
-            await self.session.set_update_state(0, types.updates.State(
-                pts=pts,
-                qts=0,
-                date=date,
-                seq=0,
-                unread_count=0
-            ))
+        if self._state_checkpoint is not None:
+            self._state_checkpoint.cancel()
+            self._state_checkpoint = None
 
+        await self._save_update_states()
         await self.session.close()
 
     async def _disconnect(self: 'TelegramClient'):
@@ -562,12 +560,12 @@ class TelegramBaseClient(abc.ABC):
         self._log[__name__].info('Reconnecting to new data center %s', new_dc)
         dc = await self._get_dc(new_dc)
 
-        await self.session.set_dc(dc.id, dc.ip_address, dc.port)
         # auth_key's are associated with a server, which has now changed
         # so it's not valid anymore. Set to None to force recreating it.
         self._sender.auth_key.key = None
-        await self.session.set_auth_key(None)
-        await self.session.save()
+        async with self.session.transaction():
+            await self.session.set_dc(dc.id, dc.ip_address, dc.port)
+            await self.session.set_auth_key(None)
         await self._disconnect()
         return await self.connect()
 
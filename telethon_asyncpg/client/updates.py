@@ -1,4 +1,5 @@
 import asyncio
+import datetime
 import inspect
 import itertools
 import random
@@ -12,6 +13,9 @@ from telethon.tl import types, functions
 if typing.TYPE_CHECKING:
     from telethon.client.telegramclient import TelegramClient
 
+# In seconds, how long after an update its state is handed over to the session.
+_STATE_CHECKPOINT_DELAY = 5
+
 
 class UpdateMethods:
 
@@ -273,9 +277,9 @@ class UpdateMethods:
         except (ConnectionError, asyncio.CancelledError):
             pass
         finally:
-            # TODO Save new pts to session
             self._state_cache._pts_date = (pts, date)
             self.session.catching_up = False
+            await self._save_update_states()
 
     # endregion
 
@@ -298,6 +302,40 @@ class UpdateMethods:
             self._process_update(update, None)
 
         self._state_cache.update(update)
+        self._schedule_state_checkpoint()
+
+    def _schedule_state_checkpoint(self: 'TelegramClient'):
+        # Handing states over is cheap since the session only buffers them,
+        # but there is no need to do it on every single update either.
+        if self._state_checkpoint is not None:
+            return
+
+        def checkpoint():
+            self._state_checkpoint = None
+            self._loop.create_task(self._save_update_states())
+
+        self._state_checkpoint = self._loop.call_later(_STATE_CHECKPOINT_DELAY, checkpoint)
+
+    async def _save_update_states(self: 'TelegramClient'):
+        """
+        Hands the general and per-channel update states over to the
+        session, which persists them in batches whenever it sees fit.
+        """
+        states = {}
+        pts, date = self._state_cache[None]
+        if pts and date:
+            states[0] = types.updates.State(
+                pts=pts, qts=0, date=date, seq=0, unread_count=0)
+
+        now = datetime.datetime.now(tz=datetime.timezone.utc)
+        for channel_id, channel_pts in vars(self._state_cache).items():
+            # StateCache stores the pts of each channel under its (int) ID
+            if isinstance(channel_id, int) and channel_pts:
+                states[channel_id] = types.updates.State(
+                    pts=channel_pts, qts=0, date=now, seq=0, unread_count=0)
+
+        if states:
+            await self.session.set_update_states(states)
 
     def _process_update(self: 'TelegramClient', update, others, entities=None):
         update._entities = entities or {}
@@ -355,6 +393,7 @@ class UpdateMethods:
             # inserted because this is a rather expensive operation
             # (default's sqlite3 takes ~0.1s to commit changes). Do
             # it every minute instead. No-op if there's nothing new.
+            await self._save_update_states()
             await self.session.save()
 
             # We need to send some content-related request at least hourly
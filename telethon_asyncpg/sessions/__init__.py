@@ -1,3 +1,5 @@
 from .abstract import AbstractAsyncSession
 from .base import BaseAsyncSession
 from .asyncpg import AsyncpgSession
+from .manager import SessionManager
+from .l2cache import AbstractL2Cache, InMemoryL2Cache, RedisL2Cache
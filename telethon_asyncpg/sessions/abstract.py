@@ -1,3 +1,4 @@
+import contextlib
 from abc import ABC, abstractmethod
 from typing import Any, Dict, Tuple
 
@@ -98,6 +99,32 @@ class AbstractAsyncSession(ABC):
         """
         raise NotImplementedError
 
+    async def get_all_update_states(self):
+        """
+        Returns ``{entity_id: UpdateState}`` with every known state, the
+        "general" one included under 0. Implementations may override it
+        to load all of them at once.
+        """
+        state = await self.get_update_state(0)
+        return {} if state is None else {0: state}
+
+    async def set_update_states(self, states):
+        """
+        Sets every ``UpdateState`` of the given ``{entity_id: state}`` mapping.
+        Implementations may override it to persist them in one batch.
+        """
+        for entity_id, state in states.items():
+            await self.set_update_state(entity_id, state)
+
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        """
+        Scope which changes are saved together on exit. Implementations
+        may override it to use one connection and commit once.
+        """
+        yield
+        await self.save()
+
     @abstractmethod
     async def close(self):
         """
@@ -2,12 +2,17 @@
 schema for asyncpg sessions is "asyncpg_telethon"
 """
 
-from typing import List, Optional, Dict, Any, Union, Callable, Tuple
+from typing import List, Optional, Dict, Any, Union, Callable, Tuple, NamedTuple, Sequence, Iterable, Mapping, AsyncIterator, Set
 import asyncio
+import base64
+import contextlib
+import contextvars
+import itertools
 import uuid
 from abc import ABC
 import datetime
 import logging
+import struct
 
 import asyncpg
 
@@ -15,8 +20,13 @@ from telethon import utils
 from telethon.crypto import AuthKey
 from telethon.tl import types
 from ..sessions.base import BaseAsyncSession
+from ..sessions.buffers import EntityBuffer
+from ..sessions.cache import LRUCache, TTLCache
+from ..sessions.l2cache import AbstractL2Cache
+from ..sessions.notify import MAX_PAYLOAD, Listener, close_listener, get_listener, make_payload
+from ..sessions.statements import StatementRegistry
 
-TABLES = ("sessions", "sent_files", "update_state",)
+TABLES = ("sessions", "entities", "sent_files", "update_state",)
 TELETHON_SQLITE_CURRENT_VERSION = 6  # database versions must be the same as telethon's original SQLite version
 ALLOWED_ENTITY_IDENTIFIER_NAMES = ("name", "username", "phone", )
 
@@ -28,6 +38,79 @@ _sfconf = {
 }
 
 _sfconf_keys = tuple(_sfconf.keys())
+_sfconf_types = {value: key for key, value in _sfconf.items()}
+
+# Negative entity cache entry, the key is known to be absent
+_NOT_FOUND = object()
+
+
+class SharedFile(NamedTuple):
+    """
+    File known to sessions sharing ``shared_files`` table.
+    """
+    # InputDocument or InputPhoto
+    type: type
+    # hint of the last holder which cached the file, see ``file_hint``
+    hint: str
+    # ids of sessions which have the file cached
+    holders: Tuple[str, ...]
+
+
+def file_hint(instance: Union[types.InputDocument, types.InputPhoto]) -> str:
+    """
+    Bot API file_id-like string of cached file: urlsafe base64 of its type, id and access hash.
+    """
+    packed = struct.pack("<Bqq", _sftype(type(instance)), instance.id, instance.access_hash)
+    return base64.urlsafe_b64encode(packed).rstrip(b"=").decode()
+
+
+def _sent_file(cls, file_id: int, file_hash: int):
+    # Both allowed classes have (id, access_hash, file_reference) as parameters,
+    # reference of a sent file is not stored
+    return cls(file_id, file_hash, b"")
+
+
+def _l2_pack(rows: Sequence[Sequence[int]]) -> bytes:
+    # first (id, hash) pair as b"id:hash", no rows as b""
+    return b"%d:%d" % tuple(rows[0][:2]) if rows else b""
+
+
+def _l2_unpack(value: bytes) -> List[Tuple[int, int]]:
+    if not value:
+        return []
+    entity_id, entity_hash = value.split(b":")
+    return [(int(entity_id), int(entity_hash))]
+
+
+class _Scope:
+    """
+    Connection of ``transaction()`` scope and what was written with it, which
+    is marked as changed again if the transaction fails. Connection is taken
+    and the transaction begun by the first statement of the scope.
+    """
+
+    __slots__ = ("pool", "conn", "stack", "session_written", "update_states")
+
+    def __init__(self, pool: asyncpg.pool.Pool):
+        self.pool = pool
+        self.conn: Optional[asyncpg.Connection] = None
+        # releases connection and commits (or rolls back) on exit
+        self.stack = contextlib.AsyncExitStack()
+        self.session_written = False
+        self.update_states: Set[int] = set()
+
+    async def begin(self) -> asyncpg.Connection:
+        if self.conn is None:
+            conn = await self.stack.enter_async_context(self.pool.acquire())
+            await self.stack.enter_async_context(conn.transaction())
+            self.conn = conn
+        return self.conn
+
+
+# id(session) -> _Scope of the session's current ``transaction()``
+_transaction_connections: contextvars.ContextVar = contextvars.ContextVar(
+    "_transaction_connections", default={}
+)
 
 
 def default_session_id_factory() -> str:
@@ -40,27 +123,62 @@ def _sftype(cls):
     return _sfconf[cls]
 
 
-async def check_tables(connection: asyncpg.Connection) -> bool:
-    for table in TABLES:
-        rec = await connection.fetchval(
-            """
-            select EXISTS(
-            select 1
-            from pg_tables
-            where schemaname = $1 and tablename = $2);
-            """, "asyncpg_telethon", table
+SCHEMA_LOCK_ID = 0x74656c65  # pg_advisory_xact_lock key of schema migrations
+INDEX_LOCK_ID = SCHEMA_LOCK_ID + 1  # pg_try_advisory(_xact)_lock key of index builds
+
+
+class ConcurrentIndex(NamedTuple):
+    """
+    Index of a migration, built with ``create index concurrently`` once the
+    migration is committed, so writes to the table go on meanwhile. Indexes
+    left missing or invalid by an interrupted build are built again on start.
+    """
+    name: str
+    table: str
+    definition: str
+
+    def query(self, concurrently: bool = True) -> str:
+        return (
+            f"create index {'concurrently ' if concurrently else ''}if not exists {self.name} "
+            f'on "asyncpg_telethon".{self.table} {self.definition};'
         )
 
-        if bool(rec) is False:
-            logger.debug(f"Table = {table} with schema `asyncpg_telethon` does not exist")
-            return False
 
-    return True
+def _create_entities(partitions: Optional[int]) -> Tuple[str, ...]:
+    """
+    Entities table, optionally hash partitioned by session_id into ``partitions`` tables.
+    """
+    table = """create table if not exists "asyncpg_telethon".entities (
+            session_id varchar(255),
+            id bigint,
+            hash bigint not null,
+            username text ,
+            phone bigint default null,
+            name text,
+            primary key(session_id, id)
+        )"""
+    if not partitions:
+        return (f"{table};",)
+
+    return (f"{table} partition by hash (session_id);", *(
+        f"""create table if not exists "asyncpg_telethon".entities_p{remainder}
+            partition of "asyncpg_telethon".entities
+            for values with (modulus {partitions}, remainder {remainder});"""
+        for remainder in range(partitions)
+    ))
 
 
-async def create_tables(connection: asyncpg.Connection, lock: asyncio.Lock):
-    create_tables_sql = (
-        """sessions (
+# Ordered (version, statements) pairs, never change applied ones - append new.
+# The first one is the layout of telethon's original SQLite session.
+# Statement may be a callable, which builds statements for layout options,
+# or ``ConcurrentIndex``, which is built out of the migration transaction.
+MIGRATIONS: Tuple[Tuple[int, Tuple[Union[str, ConcurrentIndex, Callable[[Optional[int]], Tuple[str, ...]]], ...]], ...] = (
+    (TELETHON_SQLITE_CURRENT_VERSION, (
+        """create schema if not exists "asyncpg_telethon";""",
+        """create table if not exists "asyncpg_telethon".version (
+            version integer primary key
+        );""",
+        """create table if not exists "asyncpg_telethon".sessions (
             session_id varchar(255),
             dc_id integer,
             server_address text,
@@ -68,17 +186,9 @@ async def create_tables(connection: asyncpg.Connection, lock: asyncio.Lock):
             auth_key bytea,
             takeout_id integer,
             primary key(session_id, dc_id)
-        )""",
-        """entities (
-            session_id varchar(255),
-            id bigint,
-            hash bigint not null,
-            username text ,
-            phone bigint default null,
-            name text,
-            primary key(session_id, id)
-        )""",
-        """sent_files (
+        );""",
+        _create_entities,
+        """create table if not exists "asyncpg_telethon".sent_files (
             session_id varchar(255),
             md5_digest bytea,
             file_size integer,
@@ -86,8 +196,8 @@ async def create_tables(connection: asyncpg.Connection, lock: asyncio.Lock):
             id bigint,
             hash bigint,
             primary key(session_id, md5_digest, file_size, type)
-        )""",
-        """update_state (
+        );""",
+        """create table if not exists "asyncpg_telethon".update_state (
             session_id varchar(255),
             id integer,
             pts integer,
@@ -95,18 +205,527 @@ async def create_tables(connection: asyncpg.Connection, lock: asyncio.Lock):
             date integer,
             seq integer,
             primary key(session_id, id)
-        )""")
+        );""",
+    )),
+    # Lookup indexes for get_entity_rows_by_{username,phone,name}, "include"
+    # makes them covering, so lookups are answered by index-only scans.
+    # Expression index can't give ``name`` back, so it is included as well.
+    (TELETHON_SQLITE_CURRENT_VERSION + 1, (
+        ConcurrentIndex(
+            "entities_username_idx", "entities",
+            "(session_id, username) include (id, hash) where username is not null",
+        ),
+        ConcurrentIndex(
+            "entities_phone_idx", "entities",
+            "(session_id, phone) include (id, hash) where phone is not null",
+        ),
+        ConcurrentIndex(
+            "entities_name_idx", "entities",
+            "(session_id, lower(name)) include (id, hash, name) where name is not null",
+        ),
+    )),
+    # Content addressed files shared by all sessions, used with share_files=True.
+    # Access hashes are per account, so it tells who holds the file, not how to send it.
+    (TELETHON_SQLITE_CURRENT_VERSION + 2, (
+        """create table if not exists "asyncpg_telethon".shared_files (
+            md5_digest bytea,
+            file_size integer,
+            type integer,
+            hint text,
+            holders text[] not null default '{}',
+            primary key(md5_digest, file_size)
+        );""",
+        """create index if not exists shared_files_holders_idx
+            on "asyncpg_telethon".shared_files using gin (holders);""",
+    )),
+)
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+# id(pool) -> pool, pools which schema is known to be current. Pools can't be
+# weakly referenced, they are held until closed, so their ids are not reused meanwhile.
+_current_schema_pools: Dict[int, asyncpg.pool.Pool] = {}
+
 
+async def get_schema_version(connection: asyncpg.Connection) -> Optional[int]:
+    """
+    Returns applied schema version with a single query, None if schema does not exist.
+    """
+    try:
+        return await connection.fetchval("select max(version) from asyncpg_telethon.version;")
+    except (asyncpg.InvalidSchemaNameError, asyncpg.UndefinedTableError):
+        return None
+
+
+def migration_statements(queries, partitions: Optional[int] = None) -> Iterable[str]:
+    """
+    Yields SQL statements of a migration for given layout options,
+    except of ``ConcurrentIndex`` ones.
+    """
+    for query in queries:
+        if isinstance(query, ConcurrentIndex):
+            continue
+        if callable(query):
+            yield from query(partitions)
+        else:
+            yield query
+
+
+async def _valid_indexes(connection: asyncpg.Connection) -> Set[str]:
+    return set(await connection.fetchval("""
+        select coalesce(array_agg(index.relname::text), '{}') from pg_index
+        join pg_class index on index.oid = pg_index.indexrelid
+        where index.relnamespace = 'asyncpg_telethon'::regnamespace and pg_index.indisvalid;
+    """))
+
+
+async def build_indexes(connection: asyncpg.Connection, pgbouncer: bool = False) -> None:
+    """
+    Builds ``ConcurrentIndex`` indexes of migrations which are missing or invalid.
+    Only one process builds them, the others go on without waiting for it.
+
+    Behind pgbouncer in transaction mode consecutive statements may run on
+    different server connections, which a session level lock can't survive,
+    so indexes are built in one transaction (blocking writes meanwhile)
+    under transaction level lock instead.
+
+    :param connection: connection out of transaction
+    :param pgbouncer: True - build in one transaction, not concurrently
+    """
+    indexes = [
+        query for _, queries in MIGRATIONS for query in queries if isinstance(query, ConcurrentIndex)
+    ]
+    valid = await _valid_indexes(connection)
+    if all(index.name in valid for index in indexes):
+        return
+
+    if pgbouncer:
+        async with connection.transaction():
+            if await connection.fetchval("select pg_try_advisory_xact_lock($1);", INDEX_LOCK_ID):
+                await _build_missing_indexes(connection, indexes, concurrently=False)
+        return
+
+    if not await connection.fetchval("select pg_try_advisory_lock($1);", INDEX_LOCK_ID):
+        return  # being built by another process
+
+    try:
+        await _build_missing_indexes(connection, indexes)
+    finally:
+        await connection.execute("select pg_advisory_unlock($1);", INDEX_LOCK_ID)
+
+
+async def _build_missing_indexes(
+    connection: asyncpg.Connection, indexes: List[ConcurrentIndex], concurrently: bool = True
+) -> None:
+    # could have been built by the process which has just released the lock
+    valid = await _valid_indexes(connection)
+    for index in indexes:
+        if index.name in valid:
+            continue
+
+        # partitioned tables can't be indexed concurrently
+        index_concurrently = concurrently and await connection.fetchval(
+            "select relkind <> 'p' from pg_class where oid = $1::regclass;",
+            f"asyncpg_telethon.{index.table}",
+        )
+        logger.debug(f"Building `asyncpg_telethon` index {index.name}")
+        # leftover of an interrupted build is invalid and must be built again
+        await connection.execute(
+            f"drop index {'concurrently ' if index_concurrently else ''}if exists "
+            f'"asyncpg_telethon".{index.name};'
+        )
+        await connection.execute(index.query(index_concurrently))
+
+
+async def migrate(connection: asyncpg.Connection, partitions: Optional[int] = None) -> int:
+    """
+    Applies pending migrations under advisory lock, so only one of concurrently
+    starting processes runs them while the others wait and find schema current.
+    Their ``ConcurrentIndex`` indexes are left to ``build_indexes``.
+
+    :param partitions: hash partition entities table into that many tables,
+        only has effect when the table is created.
+    """
+    async with connection.transaction():
+        await connection.execute("select pg_advisory_xact_lock($1);", SCHEMA_LOCK_ID)
+
+        version = None
+        if await connection.fetchval("select to_regclass('asyncpg_telethon.version');"):
+            version = await connection.fetchval("select max(version) from asyncpg_telethon.version;")
+
+        for migration_version, queries in MIGRATIONS:
+            if version is not None and migration_version <= version:
+                continue
+
+            logger.debug(f"Applying `asyncpg_telethon` schema migration {migration_version}")
+            for query in migration_statements(queries, partitions):
+                await connection.execute(query)
+            await connection.execute(
+                "insert into asyncpg_telethon.version(version) values ($1);", migration_version
+            )
+            version = migration_version
+
+    return version
+
+
+async def ensure_schema(
+    pool: asyncpg.pool.Pool,
+    connection: asyncpg.Connection,
+    partitions: Optional[int] = None,
+    pgbouncer: bool = False,
+) -> None:
+    """
+    Makes sure schema is current, checked once per pool.
+
+    :param pgbouncer: True - pool is behind pgbouncer in transaction mode
+    """
+    _forget_closed_pools()
+    if _current_schema_pools.get(id(pool)) is pool:
+        return
+
+    version = await get_schema_version(connection)
+    if version is None or version < SCHEMA_VERSION:
+        await migrate(connection, partitions)
+    await build_indexes(connection, pgbouncer)
+
+    _current_schema_pools[id(pool)] = pool
+
+
+def _forget_closed_pools() -> None:
+    for key, pool in list(_current_schema_pools.items()):
+        if pool.is_closing():
+            del _current_schema_pools[key]
+
+
+def forget_pool(pool: Optional[asyncpg.pool.Pool] = None) -> None:
+    """
+    Forgets that schema of ``pool`` is current, and of every closed pool.
+    """
+    if pool is not None and _current_schema_pools.get(id(pool)) is pool:
+        del _current_schema_pools[id(pool)]
+    _forget_closed_pools()
+
+
+class Upsert(NamedTuple):
+    """
+    Description of an upsert into one of "asyncpg_telethon" tables.
+    """
+    table: str
+    columns: Tuple[str, ...]
+    key: Tuple[str, ...]
+    # optional condition of "do update", stored row is ``table``, new one is ``excluded``
+    condition: str = ""
+
+    @property
+    def query(self) -> str:
+        return (
+            f"insert into asyncpg_telethon.{self.table}({', '.join(self.columns)}) "
+            f"values ({', '.join(f'${n}' for n in range(1, len(self.columns) + 1))}) "
+            f"on conflict({', '.join(self.key)}) do update set {self._assignments}{self._where};"
+        )
+
+    @property
+    def staged_query(self) -> str:
+        # ``distinct on`` keeps a single row per key (the last copied one),
+        # otherwise "on conflict" fails to affect the same row twice.
+        columns = ", ".join(self.columns)
+        return (
+            f"insert into asyncpg_telethon.{self.table}({columns}) "
+            f"select distinct on ({', '.join(self.key)}) {columns} from {self.stage} "
+            f"order by {', '.join(self.key)}, ctid desc "
+            f"on conflict({', '.join(self.key)}) do update set {self._assignments}{self._where};"
+        )
+
+    @property
+    def stage(self) -> str:
+        return f"_stage_{self.table}"
+
+    @property
+    def _where(self) -> str:
+        return f" where {self.condition}" if self.condition else ""
+
+    @property
+    def _assignments(self) -> str:
+        return ", ".join(
+            f"{column} = excluded.{column}"
+            for column in self.columns if column not in self.key
+        )
+
+
+class EntityRow(NamedTuple):
+    """
+    Entity row in parameter order of entities upsert, goes to the driver as is.
+    """
+    session_id: str
+    id: int
+    hash: int
+    username: Optional[str]
+    phone: Optional[int]
+    name: Optional[str]
+
+
+class UpdateStateRow(NamedTuple):
+    """
+    Update state row in parameter order of update_state upsert.
+    """
+    session_id: str
+    id: int
+    pts: int
+    qts: int
+    date: int
+    seq: int
+
+
+UPSERTS = {
+    "entities": Upsert(
+        "entities",
+        ("session_id", "id", "hash", "username", "phone", "name"),
+        ("session_id", "id"),
+    ),
+    "sent_files": Upsert(
+        "sent_files",
+        ("session_id", "md5_digest", "file_size", "type", "id", "hash"),
+        ("session_id", "md5_digest", "file_size", "type"),
+    ),
+    "update_state": Upsert(
+        "update_state",
+        ("session_id", "id", "pts", "qts", "date", "seq"),
+        ("session_id", "id"),
+        # pts never goes back, e.g. when an older process writes after a newer one
+        "update_state.pts < excluded.pts"
+        " or (update_state.pts = excluded.pts and update_state.date <= excluded.date)",
+    ),
+}
+
+
+STATEMENTS = {
+    "sessions_upsert": """
+        insert into 
+        asyncpg_telethon.sessions (session_id, dc_id, server_address, port, auth_key, takeout_id) 
+        values ($1, $2, $3, $4, $5, $6) 
+        on conflict(session_id, dc_id) do 
+        update set server_address = $3, port = $4,
+        auth_key = $5, takeout_id = $6;
+    """,
+    "sessions_get": """
+        select server_address, port, auth_key, takeout_id
+        from asyncpg_telethon.sessions
+        where sessions.session_id = $1 and dc_id = $2;
+    """,
+    "notify": "select pg_notify($1, $2);",
+    "update_state_get": """
+        select pts, qts, date, seq
+        from asyncpg_telethon.update_state 
+        where update_state.session_id = $1 and id = $2;
+    """,
+    "update_state_all": """
+        select id, pts, qts, date, seq
+        from asyncpg_telethon.update_state 
+        where update_state.session_id = $1;
+    """,
+    "entities_by_id": """
+        select id, hash from asyncpg_telethon.entities
+        where entities.session_id = $1 and id = $2;
+    """,
+    "entities_by_ids": """
+        select id, hash from asyncpg_telethon.entities
+        where entities.session_id = $1 and id in ($2, $3, $4);
+    """,
+    "entities_by_username": """
+        select id, hash from asyncpg_telethon.entities
+        where entities.session_id = $1 and username = $2;
+    """,
+    "entities_by_phone": """
+        select id, hash from asyncpg_telethon.entities
+        where entities.session_id = $1 and phone = $2;
+    """,
+    "entities_by_name": """
+        select id, hash from asyncpg_telethon.entities
+        where entities.session_id = $1 and lower(name) = lower($2);
+    """,
+    "entities_iter": """
+        select id, hash, username, phone, name from asyncpg_telethon.entities
+        where entities.session_id = $1;
+    """,
+    "sessions_list": """
+        select distinct session_id from asyncpg_telethon.sessions order by session_id;
+    """,
+    "sent_files_all": """
+        select md5_digest, file_size, type, id, hash from asyncpg_telethon.sent_files
+        where sent_files.session_id = $1 limit $2;
+    """,
+    "shared_files_upsert": """
+        insert into asyncpg_telethon.shared_files (md5_digest, file_size, type, hint, holders)
+        values ($1, $2, $3, $4, array[$5::text])
+        on conflict(md5_digest, file_size) do update set type = $3, hint = $4,
+        holders = case when $5 = any(shared_files.holders) then shared_files.holders
+            else array_append(shared_files.holders, $5::text) end;
+    """,
+    "shared_files_get": """
+        select type, hint, holders from asyncpg_telethon.shared_files
+        where md5_digest = $1 and file_size = $2;
+    """,
+    "shared_files_forget": """
+        update asyncpg_telethon.shared_files set holders = array_remove(holders, $1::text)
+        where holders @> array[$1::text];
+    """,
+    "sent_files_get": """
+        select id, hash from asyncpg_telethon.sent_files 
+        where sent_files.session_id = $1 and md5_digest = $2 and file_size = $3 and type = $4;
+    """,
+    **{f"{name}_upsert": upsert.query for name, upsert in UPSERTS.items()},
+    # table is sure safe to be passed by f'' to query.
+    **{
+        f"{table}_delete": f"delete from asyncpg_telethon.{table} where {table}.session_id = $1;"
+        for table in TABLES
+    },
+}
+
+# Shared by every session: statements are prepared once per pooled connection
+statements = StatementRegistry(STATEMENTS)
+# For pgbouncer in transaction mode, where named prepared statements don't survive
+unprepared_statements = StatementRegistry(STATEMENTS, prepare=False)
+
+
+async def upsert_rows(
+    connection: asyncpg.Connection,
+    upsert: Upsert,
+    rows: Sequence[Sequence[Any]],
+    copy_threshold: int = 100,
+    registry: StatementRegistry = statements,
+) -> None:
+    """
+    Upserts rows with ``executemany`` or, for batches of at least ``copy_threshold``
+    rows, copies them into temporary staging table and upserts with one statement.
+    """
+    if len(rows) < copy_threshold:
+        await registry.executemany(connection, f"{upsert.table}_upsert", rows)
+        return
+
+    async with connection.transaction():
+        await connection.execute(
+            f"create temporary table {upsert.stage} "
+            f"(like asyncpg_telethon.{upsert.table} including defaults) on commit drop;"
+        )
+        await connection.copy_records_to_table(
+            upsert.stage, records=rows, columns=upsert.columns
+        )
+        await connection.execute(upsert.staged_query)
+        # staging table must not outlive this upsert in case of outer transaction
+        await connection.execute(f"drop table {upsert.stage};")
+
+
+def l2_entity_key(session_id: str, coln: str, colval: Any) -> str:
+    """
+    Key of entity lookup by ``coln`` in L2 cache.
+    """
+    if coln == "name":
+        colval = colval.lower()
+    return f"{session_id}:entity:{coln}:{colval}"
+
+
+async def invalidate_l2_entities(l2_cache: AbstractL2Cache, rows: Iterable[EntityRow]) -> None:
+    """
+    Forgets lookups of written entity rows, L2 cache failures are only logged.
+    """
+    keys = [
+        l2_entity_key(row.session_id, coln, value)
+        for row in rows
+        for coln, value in (("id", row.id), ("username", row.username), ("phone", row.phone), ("name", row.name))
+        if value
+    ]
+    try:
+        await l2_cache.delete(keys)
+    except Exception:
+        logger.warning("L2 cache invalidation has failed", exc_info=True)
+
+
+async def flush_entity_buffer(
+    acquire: Callable[[], Any],
+    buffer: EntityBuffer,
+    lock: asyncio.Lock,
+    copy_threshold: int = 100,
+    registry: StatementRegistry = statements,
+    notify_channel: Optional[str] = None,
+    l2_cache: Optional[AbstractL2Cache] = None,
+) -> None:
+    """
+    Writes all buffered entities in one batch, failed rows are put back to buffer.
+
+    :param acquire: ``pool.acquire`` or alike, gives connection to write with
+    :param notify_channel: NOTIFY channel to tell ids of written entities per session
+    :param l2_cache: L2 cache to forget lookups of written entities in, once they are written
+    """
     async with lock:
-        logger.debug(f"Creating schema(`asyncpg_telethon`) and tables: {TABLES} with schema `asyncpg_telethon`")
-        async with connection.transaction(isolation="read_committed"):
-            await connection.execute("""create schema if not exists "asyncpg_telethon";""")
-            # table is sure safe to be passed by f'' to query.
-            await connection.execute("".join(
-                f"""create table if not exists "asyncpg_telethon".{table};"""
-                for table in create_tables_sql
-            ))
-        logger.debug("Tables created")
+        rows = buffer.drain()
+        if not rows:
+            return
+
+        try:
+            async with acquire() as conn:  # type: asyncpg.Connection
+                await upsert_rows(conn, UPSERTS["entities"], rows, copy_threshold, registry)
+                if notify_channel is not None:
+                    await notify_entities(conn, notify_channel, rows, registry)
+        except BaseException:
+            buffer.restore(rows)
+            raise
+
+        # earlier, a peer could load the old rows from postgres into L2 again
+        if l2_cache is not None:
+            await invalidate_l2_entities(l2_cache, rows)
+
+
+async def iter_records(
+    acquire: Callable[[], Any],
+    query: str,
+    *args: Any,
+    batch_size: int = 1000
+) -> AsyncIterator[Tuple]:
+    """
+    Yields rows of query as tuples, fetched by server-side cursor ``batch_size``
+    rows at a time. Connection is held until the generator is exhausted or closed.
+
+    :param acquire: ``pool.acquire`` or alike, gives connection to read with
+    """
+    async with acquire() as conn:  # type: asyncpg.Connection
+        # cursors only live inside of transaction
+        async with conn.transaction():
+            async for record in conn.cursor(query, *args, prefetch=batch_size):
+                yield tuple(record)
+
+
+async def notify_entities(
+    connection: asyncpg.Connection,
+    channel: str,
+    rows: Iterable[Sequence[Any]],
+    registry: StatementRegistry = statements,
+) -> None:
+    """
+    Sends one notification per session with ids of its written entity rows.
+    """
+    ids: Dict[str, List[int]] = {}
+    for row in rows:
+        ids.setdefault(row[0], []).append(row[1])
+
+    for session_id, entity_ids in ids.items():
+        payload = make_payload(session_id, "entities", ids=entity_ids)
+        if len(payload) > MAX_PAYLOAD:
+            # too many to list, listeners forget every entity of session
+            payload = make_payload(session_id, "entities")
+        await registry.execute(connection, "notify", channel, payload)
+
+
+@contextlib.asynccontextmanager
+async def _joined(scope: _Scope) -> AsyncIterator[asyncpg.Connection]:
+    # acquire-like context for connection of transaction scope, released by the scope
+    yield await scope.begin()
+
+
+def _leave_transactions():
+    """
+    Background tasks inherit context of the scheduling task, but must not use
+    its transaction connection, which may be released by the time they run.
+    """
+    _transaction_connections.set({})
 
 
 class AsyncpgSession(BaseAsyncSession, ABC):
@@ -114,40 +733,137 @@ class AsyncpgSession(BaseAsyncSession, ABC):
         self,
         asyncpg_conf: Optional[Union[str, Dict[str, Any]]],
         session_id_factory: Callable[[], str] = default_session_id_factory,
-        save_entities: bool = True
+        save_entities: bool = True,
+        entity_flush_size: int = 1000,
+        entity_flush_interval: float = 5.0,
+        entity_offload_threshold: Optional[int] = 5000,
+        copy_threshold: int = 100,
+        fingerprint_cache_size: int = 10000,
+        file_cache_size: int = 10000,
+        share_files: bool = False,
+        entity_cache_size: int = 10000,
+        entity_cache_ttl: float = 300.0,
+        entity_negative_ttl: float = 30.0,
+        session_flush_delay: Optional[float] = 1.0,
+        update_state_flush_interval: float = 5.0,
+        pgbouncer: bool = False,
+        partitions: Optional[int] = None,
+        l2_cache: Optional[AbstractL2Cache] = None,
+        notify_channel: Optional[str] = None
     ):
         """
         Initializer for AsyncpgSession
         :param asyncpg_conf: asyncpg.create_pool configs
         :param session_id_factory: function to generate session identifier
         :param save_entities: True - all entities will be cached while processing
+        :param entity_flush_size: buffered entities count which triggers an early flush
+        :param entity_flush_interval: max seconds entities may stay buffered before flush
+        :param entity_offload_threshold: entities count of a result starting from which rows
+            are extracted in executor, not to block event loop, None - never
+        :param copy_threshold: rows count starting from which upserts are done with COPY
+        :param fingerprint_cache_size: amount of entities remembered to skip unchanged upserts
+        :param file_cache_size: amount of sent files kept in memory, loaded at start
+        :param share_files: True - record cached files in table shared by all sessions,
+            see ``get_shared_file``
+        :param entity_cache_size: amount of lookups kept in the read-through entity cache
+        :param entity_cache_ttl: seconds a found entity is answered from the cache
+        :param entity_negative_ttl: seconds an unknown entity is answered from the cache
+        :param session_flush_delay: seconds changed dc/auth key/takeout id wait for a write
+            unless ``save`` comes first, None - write only on ``save``/``close``
+        :param update_state_flush_interval: max seconds changed update states wait for a write
+        :param pgbouncer: True - don't use prepared statements (pgbouncer transaction mode)
+        :param partitions: create entities table hash partitioned by session into that many tables
+        :param l2_cache: cache shared with other processes, asked for entities and files before postgres
+        :param notify_channel: postgres channel to NOTIFY other processes serving the same session
+            about changes and LISTEN to theirs, None - don't
         """
         super().__init__()
         self._session_id = session_id_factory()
         self.save_entities = save_entities
-        self._conf = asyncpg_conf if isinstance(asyncpg_conf, dict) else {"dsn": asyncpg_conf}
+        self._conf = dict(asyncpg_conf) if isinstance(asyncpg_conf, dict) else {"dsn": asyncpg_conf}
+        self._statements = unprepared_statements if pgbouncer else statements
+        if pgbouncer:
+            self._conf.setdefault("statement_cache_size", 0)
         self._pool: Optional[asyncpg.pool.Pool] = None
+        self._owns_pool = False
+        self._schema_ready = False
+        self._partitions = partitions
         self._lock = asyncio.Lock()
-        self._conn: Optional[asyncpg.Connection] = None
+        self.copy_threshold = copy_threshold
+
+        self._entity_buffer = EntityBuffer(entity_flush_size, entity_flush_interval)
+        self._flush_lock = asyncio.Lock()
+        self._flush_task: Optional[asyncio.Future] = None
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._entity_offload_threshold = entity_offload_threshold
+        # number of result extracted in executor -> marked ids buffered by newer results meanwhile
+        self._offloads: Dict[int, Set[int]] = {}
+        self._offload_numbers = itertools.count()
+
+        self._session_dirty = False
+        self._session_flush_delay = session_flush_delay
+        self._session_handle: Optional[asyncio.TimerHandle] = None
+
+        self._dirty_update_states = set()
+        self._update_state_flush_interval = update_state_flush_interval
+        self._update_states_handle: Optional[asyncio.TimerHandle] = None
+
+        # marked id -> hash of (hash, username, phone, name) known to be stored
+        self._fingerprints = LRUCache(fingerprint_cache_size)
+        # (md5_digest, file_size, type) -> (id, hash) of sent files
+        self._files = LRUCache(file_cache_size)
+        self.share_files = share_files
+        self._skipped_entities = 0
+
+        # ("id" | "username" | "phone" | "name", value) -> (id, hash) or _NOT_FOUND
+        self._entity_cache = TTLCache(entity_cache_size, entity_cache_ttl)
+        self._entity_negative_ttl = entity_negative_ttl
+        self._l2_cache = l2_cache
+
+        self._notify_channel = notify_channel
+        self._listener: Optional[Listener] = None
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        """
+        Counters of in-process caches.
+        """
+        return {
+            "fingerprint_hits": self._fingerprints.hits,
+            "fingerprint_misses": self._fingerprints.misses,
+            "fingerprint_skips": self._skipped_entities,
+            "entity_cache_hits": self._entity_cache.hits,
+            "entity_cache_misses": self._entity_cache.misses,
+        }
+
+    @property
+    def statement_stats(self) -> Dict[str, Dict[str, float]]:
+        """
+        Calls and total seconds per named statement (shared by all sessions).
+        """
+        return self._statements.stats
 
     @classmethod
     def with_pool(
         cls,
         asyncpg_pool: asyncpg.pool.Pool,
         session_id_factory: Callable[[], str] = default_session_id_factory,
-        save_entities: bool = True
+        save_entities: bool = True,
+        **kwargs: Any
     ) -> 'AsyncpgSession':
         """
         Another implementation of initializer but for shared pool
         :param asyncpg_pool: ready asyncpg Pool
         :param session_id_factory: ...
         :param save_entities: ...
+        :param kwargs: other AsyncpgSession initializer options
         :return: instance of AsyncpgSession
         """
         self = cls(
             asyncpg_conf=None,
             session_id_factory=session_id_factory,
-            save_entities=save_entities
+            save_entities=save_entities,
+            **kwargs
         )  # type: ignore
         self._pool = asyncpg_pool
         return self
@@ -159,53 +875,139 @@ class AsyncpgSession(BaseAsyncSession, ABC):
         if not isinstance(self._pool, asyncpg.pool.Pool):
             # no more than one pool should be opened in one instance
             self._pool = await asyncpg.create_pool(**self._conf)
+            self._owns_pool = True
 
-        async with self._pool.acquire() as conn:  # type: asyncpg.Connection
-            if (await check_tables(conn)) is False:
-                await create_tables(conn, self._lock)
+        if not self._schema_ready:
+            async with self._pool.acquire() as conn:  # type: asyncpg.Connection
+                await ensure_schema(self._pool, conn, self._partitions, not self._statements.prepare)
+            self._schema_ready = True
+
+        await self._listen()
 
-            async with self._lock:
-                for method, (args, kwargs) in settings.items():
-                    try:
-                        self._conn = conn
+        async with self._lock:
+            try:
+                # settings share one connection and are committed at once
+                async with self.transaction():
+                    for method, (args, kwargs) in settings.items():
                         await method(*args, **kwargs)
-                    except asyncpg.InterfaceError as exc:
-                        await self.close()
-                        raise exc
-                else:
-                    self.started = True
-                    self._conn = None
-                    await conn.close()
+                    await self._load_files()
+            except asyncpg.InterfaceError as exc:
+                await self.close()
+                raise exc
+            else:
+                self.started = True
+
+    @contextlib.asynccontextmanager
+    async def transaction(self) -> AsyncIterator[None]:
+        """
+        Scope in which all calls of this session (of the current task and tasks
+        it starts) share one pooled connection and one transaction. Changed
+        session row and update states are written before commit and marked as
+        changed again if the transaction fails. Buffered entities are shared
+        with other sessions and flushed after commit, once the connection is
+        released. Nested scopes join the outer one.
+
+        Connection is acquired and the transaction begun by the first statement
+        of the scope. Scope which only changes the session row (or only update
+        states) writes it with a single statement, without BEGIN and COMMIT.
+
+        Session calls inside the scope must not run concurrently, as they
+        share one connection.
+
+        Example:
+            async with session.transaction():
+                await session.set_dc(...)
+                await session.set_auth_key(...)
+                await session.save()
+        """
+        connections = _transaction_connections.get()
+        if id(self) in connections:
+            yield
+            return
+
+        scope = _Scope(self._pool)
+        try:
+            async with scope.stack:
+                token = _transaction_connections.set({**connections, id(self): scope})
+                try:
+                    yield
+                    if scope.conn is None and not (self._session_dirty and self._dirty_update_states):
+                        # single write is atomic on its own
+                        _transaction_connections.reset(token)
+                        token = None
+                    await self._update_session_table()
+                    await self._flush_update_states()
+                finally:
+                    if token is not None:
+                        _transaction_connections.reset(token)
+        except BaseException:
+            # rolled back (or failed to commit), write it again later
+            if scope.session_written:
+                self._mark_session_dirty()
+            self._dirty_update_states |= scope.update_states
+            raise
+
+        await self._flush_entities()
+
+    def _scope(self) -> Optional[_Scope]:
+        return _transaction_connections.get().get(id(self))
+
+    def _acquire(self):
+        """
+        Connection of the current ``transaction()`` or a new one from pool.
+        """
+        scope = self._scope()
+        if scope is None:
+            return self._pool.acquire()
+        return _joined(scope)
 
     async def set_dc(self, dc_id, server_address, port):
         # Fetch the auth_key corresponding to this data center
         self._dc_id = dc_id
         self._port = port
         self._server_address = server_address
-        await self._update_session_table()
+        self._mark_session_dirty()
 
     async def set_auth_key(self, auth_key: AuthKey):
         self._auth_key = AuthKey(data=auth_key)
-        await self._update_session_table()
+        self._mark_session_dirty()
 
     async def set_takeout_id(self, takeout_id: int):
         self._takeout_id = takeout_id
-        await self._update_session_table()
+        self._mark_session_dirty()
+
+    def _mark_session_dirty(self):
+        """
+        Session row is written by ``save``/``close`` or after a short debounce,
+        so setters called back to back cost one write.
+        """
+        self._session_dirty = True
+        if self._session_handle is None and self._session_flush_delay is not None:
+            self._session_handle = asyncio.get_event_loop().call_later(
+                self._session_flush_delay,
+                lambda: asyncio.ensure_future(self._background_session_update()),
+            )
+
+    async def _background_session_update(self):
+        _leave_transactions()
+        try:
+            await self._update_session_table()
+        except Exception:  # row stays dirty, next save will retry it
+            logger.exception("Background write of session has failed")
 
     async def _update_session_table(self):
         """
-        Method is not responsible to close connection he hasn't opened.
-        """
-        query, args = """
-            insert into 
-            asyncpg_telethon.sessions (session_id, dc_id, server_address, port, auth_key, takeout_id) 
-            values ($1, $2, $3, $4, $5, $6) 
-            on conflict(session_id, dc_id) do 
-            update set dc_id = $2,
-            server_address = $3, port = $4,
-            auth_key = $5, takeout_id = $6 
-            where sessions.session_id = $1;
-        """, (
+        Writes session row if it has changed.
+        """
+        if self._session_handle is not None:
+            self._session_handle.cancel()
+            self._session_handle = None
+
+        if not self._session_dirty:
+            return
+
+        self._session_dirty = False
+        args = (
             self._session_id,
             self._dc_id,
             self._server_address,
@@ -214,71 +1016,376 @@ class AsyncpgSession(BaseAsyncSession, ABC):
             self._takeout_id
         )
 
-        if self._conn is not None:
-            await self._conn.execute(query, *args)
-            return
+        try:
+            async with self._acquire() as conn:  # type: asyncpg.Connection
+                await self._statements.execute(conn, "sessions_upsert", *args)
+                await self._notify(conn, "session", dc=self._dc_id)
+        except BaseException:
+            self._session_dirty = True
+            raise
 
-        else:
-            async with self._pool.acquire() as conn:  # type: asyncpg.Connection
-                await conn.execute(query, *args)
+        scope = self._scope()
+        if scope is not None:
+            scope.session_written = True
 
     async def get_update_state(self, entity_id):
-        query = """
-            select pts, qts, date, seq
-            from asyncpg_telethon.update_state 
-            where update_state.session_id = $1 and id = $2;
-        """
+        state = self._update_states.get(entity_id)
+        if state is not None:
+            return state
 
-        async with self._pool.acquire() as conn:  # type: asyncpg.Connection
-            row = await conn.fetchrow(
-                query, self._session_id, entity_id
+        async with self._acquire() as conn:  # type: asyncpg.Connection
+            row = await self._statements.fetchrow(
+                conn, "update_state_get", self._session_id, entity_id
             )
             if row:
-                pts, qts, date, seq = row.values()
-                date = datetime.datetime.fromtimestamp(date, tz=datetime.timezone.utc)
-                return types.updates.State(pts, qts, date, seq, unread_count=0)
-
-    async def set_update_state(self, entity_id, state, connection: asyncpg.Connection = None):
-        query = """
-            insert into asyncpg_telethon.update_state(session_id, id, pts, qts, date, seq) values ($2,$3,$4,$5,$6,$7) 
-            on conflict(session_id, id) do 
-            update set id = $2, pts = $3, qts = $4, date = $5, seq = $6 
-            where update_state.session_id = $1;
-        """
-        async with self._pool.acquire() as conn:  # type: asyncpg.Connection
-            await conn.execute(
-                query, self._session_id, entity_id, state.pts,
-                state.qts, state.date.timestamp(), state.seq
+                pts, qts, date, seq = row
+                state = types.updates.State(
+                    pts, qts, datetime.datetime.fromtimestamp(date, tz=datetime.timezone.utc),
+                    seq, unread_count=0
+                )
+                self._update_states.setdefault(entity_id, state)
+                return state
+
+    async def get_all_update_states(self):
+        async with self._acquire() as conn:  # type: asyncpg.Connection
+            rows = await self._statements.fetch(conn, "update_state_all", self._session_id)
+
+        for entity_id, pts, qts, date, seq in rows:
+            date = datetime.datetime.fromtimestamp(date, tz=datetime.timezone.utc)
+            self._update_states.setdefault(
+                entity_id, types.updates.State(pts, qts, date, seq, unread_count=0)
+            )
+        return dict(self._update_states)
+
+    async def set_update_state(self, entity_id, state):
+        await self.set_update_states({entity_id: state})
+
+    async def set_update_states(self, states: Mapping[int, types.updates.State]):
+        """
+        Batched form of ``set_update_state``.
+
+        States are kept in memory and written in one batch by ``save``, ``close``
+        or ``update_state_flush_interval`` seconds after change. States which
+        pts would go back are ignored.
+        """
+        for entity_id, state in states.items():
+            if state.pts is None:
+                continue
+
+            known = self._update_states.get(entity_id)
+            if known is not None and not (
+                state.pts > known.pts
+                # channel states carry no meaningful date, only general one may advance by it
+                or (entity_id == 0 and state.pts == known.pts and state.date > known.date)
+            ):
+                continue
+
+            self._update_states[entity_id] = state
+            self._dirty_update_states.add(entity_id)
+
+        if self._dirty_update_states and self._update_states_handle is None:
+            self._update_states_handle = asyncio.get_event_loop().call_later(
+                self._update_state_flush_interval,
+                lambda: asyncio.ensure_future(self._background_update_states_flush()),
+            )
+
+    async def _background_update_states_flush(self):
+        _leave_transactions()
+        try:
+            await self._flush_update_states()
+        except Exception:  # states stay dirty, next flush will retry them
+            logger.exception("Background flush of update states has failed")
+
+    async def _flush_update_states(self):
+        """
+        Writes changed update states in one batch.
+        """
+        if self._update_states_handle is not None:
+            self._update_states_handle.cancel()
+            self._update_states_handle = None
+
+        dirty, self._dirty_update_states = self._dirty_update_states, set()
+        rows = []
+        for entity_id in dirty:
+            state = self._update_states[entity_id]
+            rows.append(UpdateStateRow(
+                self._session_id, entity_id, state.pts,
+                state.qts, int(state.date.timestamp()), state.seq
+            ))
+
+        if not rows:
+            return
+
+        try:
+            async with self._acquire() as conn:  # type: asyncpg.Connection
+                await upsert_rows(
+                    conn, UPSERTS["update_state"], rows, self.copy_threshold, self._statements
+                )
+        except BaseException:
+            self._dirty_update_states |= dirty
+            raise
+
+        scope = self._scope()
+        if scope is not None:
+            scope.update_states |= dirty
+
+    async def _notify(self, conn: asyncpg.Connection, kind: str, **fields: Any) -> None:
+        """
+        Tells other processes about change, delivered on commit of transaction if any.
+        """
+        if self._notify_channel is not None:
+            await self._statements.execute(
+                conn, "notify", self._notify_channel, make_payload(self._session_id, kind, **fields)
+            )
+
+    async def _listen(self) -> None:
+        """
+        Subscribes to changes of this session made by other processes.
+        """
+        if self._notify_channel is not None and self._listener is None:
+            self._listener = get_listener(self._pool)
+            await self._listener.subscribe(
+                self._notify_channel, self._session_id, self._on_notification
             )
 
+    def _on_notification(self, message: Dict[str, Any]) -> None:
+        """
+        Forgets or reloads local state changed by another process.
+        """
+        kind = message["k"]
+        if kind == "session":
+            asyncio.ensure_future(self._reload_session(message.get("dc")))
+
+        elif kind == "entities":
+            ids = message.get("ids")
+            if ids is None:
+                self._entity_cache.clear()
+                self._fingerprints.clear()
+                return
+
+            ids = set(ids)
+            for entity_id in ids:
+                self._fingerprints.pop(entity_id)
+            # misses may be found now as well
+            self._entity_cache.discard(lambda key, value: value is _NOT_FOUND or value[0] in ids)
+
+        elif kind == "delete":
+            self._entity_cache.clear()
+            self._fingerprints.clear()
+            self._files.clear()
+            self._update_states.clear()
+            self._dirty_update_states.clear()
+
+    async def _reload_session(self, dc_id: int) -> None:
+        _leave_transactions()
+        if self._session_dirty:
+            return  # local change is newer and about to be written
+
+        try:
+            async with self._pool.acquire() as conn:  # type: asyncpg.Connection
+                row = await self._statements.fetchrow(conn, "sessions_get", self._session_id, dc_id)
+        except Exception:
+            logger.exception("Reload of session changed by another process has failed")
+            return
+
+        if row is None or self._session_dirty:
+            return
+
+        self._dc_id = dc_id
+        self._server_address, self._port, auth_key, self._takeout_id = row
+        self._auth_key = AuthKey(data=auth_key)
+
     async def process_entities(self, tlo):
         """Processes all the found entities on the given TLObject,
            unless .enabled is False.
 
-           Returns True if new input entities were added.
+           Entities are not written right away but buffered, buffer is
+           flushed by ``save``, ``close`` or when it grows too big/old.
         """
         if not self.save_entities:
             return
 
-        rows = self._entities_to_rows(tlo)
+        entities = self._collect_entities(tlo)
+        threshold = self._entity_offload_threshold
+        if threshold is None or len(entities) < threshold:
+            rows = self._entities_to_rows(entities)
+            if rows:
+                await self._buffer_entity_rows(rows)
+            return
+
+        # results processed meanwhile are newer, their rows win over these
+        number = next(self._offload_numbers)
+        newer = self._offloads[number] = set()
+        try:
+            rows = await asyncio.get_event_loop().run_in_executor(
+                None, self._entities_to_rows, entities
+            )
+            # caches are not thread safe, rows are buffered on the loop piece by piece
+            for start in range(0, len(rows), threshold):
+                if start:
+                    await asyncio.sleep(0)
+                await self._buffer_entity_rows(
+                    [row for row in rows[start:start + threshold] if row.id not in newer], number
+                )
+        finally:
+            del self._offloads[number]
+
+    async def _buffer_entity_rows(self, rows, offload: Optional[int] = None):
+        """
+        Caches rows and buffers those which have changed for the next flush.
+
+        :param offload: number of result extracted in executor the rows are of,
+            None - of the newest result
+        """
+        for number, newer in self._offloads.items():
+            if number == offload:
+                break
+            # results still in executor are older and must not override these
+            newer.update(row.id for row in rows)
+
+        self._cache_entity_rows(rows)
+
+        rows = self._changed_rows(rows)
         if not rows:
             return
 
-        query = """
-            insert into asyncpg_telethon.entities(session_id, id, hash, username, phone, name) 
-            values ($1,$2,$3,$4,$5,$6) 
-            on conflict(session_id, id) do 
-            update set id = $2, hash = $3, username = $4, phone = $5, name = $6 
-            where entities.session_id = $1;
+        was_empty = not self._entity_buffer
+        self._entity_buffer.add(rows)
+
+        if self._entity_buffer.should_flush():
+            self._schedule_flush()
+        elif was_empty:
+            self._flush_handle = asyncio.get_event_loop().call_later(
+                self._entity_buffer.max_delay, self._schedule_flush
+            )
+
+    def _entity_values_to_row(self, id, hash, username, phone, name):
+        # phone column is bigint, telethon gives it as str
+        return EntityRow(self._session_id, id, hash, username, int(phone) if phone else None, name)
+
+    def _changed_rows(self, rows):
+        """
+        Drops rows which fingerprint matches the last one written for the entity.
+        """
+        changed = []
+        for row in rows:
+            fingerprint = hash(row[2:])
+            if self._fingerprints.get(row.id) == fingerprint:
+                self._skipped_entities += 1
+                continue
+
+            self._fingerprints.set(row.id, fingerprint)
+            changed.append(row)
+        return changed
+
+    def _schedule_flush(self):
+        """
+        Starts background flush of buffered entities unless one is running.
+        """
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.ensure_future(self._background_flush())
+
+    async def _background_flush(self):
+        _leave_transactions()
+        try:
+            await self._flush_entities()
+        except Exception:  # rows are restored, next flush will retry them
+            logger.exception("Background flush of entities has failed")
+
+    async def _flush_entities(self):
+        """
+        Writes all buffered entities in one batch.
+        """
+        if self._scope() is not None:
+            # flush lock is shared and its holder may wait for a pooled
+            # connection, which must not be held meanwhile
+            return
+
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        await flush_entity_buffer(
+            self._acquire, self._entity_buffer, self._flush_lock,
+            self.copy_threshold, self._statements, self._notify_channel, self._l2_cache
+        )
+
+    def _cache_entity_rows(self, rows):
+        """
+        Fills read-through entity cache with ``EntityRow`` rows.
+        """
+        for _, entity_id, entity_hash, username, phone, name in rows:
+            value = (entity_id, entity_hash)
+            self._entity_cache.set(("id", entity_id), value)
+            if username:
+                self._entity_cache.set(("username", username), value)
+            if phone:
+                self._entity_cache.set(("phone", phone), value)
+            if name:
+                # names are looked up as the last resort, forget possible miss
+                self._entity_cache.pop(("name", name.lower()))
+
+    async def _get_cached_entity_rows(
+        self, coln: str, colval: Any, loader: Callable[[], Any]
+    ) -> List[Tuple[int, int]]:
+        """
+        Answers lookup from entity cache, buffered entities or L2 cache,
+        otherwise calls (database) loader. Result is cached.
         """
+        # names are compared case-insensitively
+        cache_key = (coln, colval.lower() if coln == "name" else colval)
+        cached = self._entity_cache.get(cache_key)
+        if cached is _NOT_FOUND:
+            return []
+        if cached is not None:
+            return [cached]
+
+        rows = self._entity_buffer.find(self._session_id, coln, colval)
+        if not rows:
+            if self._l2_cache is None:
+                rows = await loader()
+            else:
+                key = self._l2_entity_key(coln, colval)
+                packed = await self._l2_get(key)
+                if packed is not None:
+                    rows = _l2_unpack(packed)
+                else:
+                    rows = await loader()
+                    await self._l2_set(
+                        key, _l2_pack(rows),
+                        self._entity_cache.ttl if rows else self._entity_negative_ttl
+                    )
+
+        if rows:
+            self._entity_cache.set(cache_key, tuple(rows[0]))
+        else:
+            self._entity_cache.set(cache_key, _NOT_FOUND, ttl=self._entity_negative_ttl)
+        return rows
+
+    def _l2_entity_key(self, coln: str, colval: Any) -> str:
+        return l2_entity_key(self._session_id, coln, colval)
 
-        for n, row in enumerate(rows):
-            row = list(row)
-            row.insert(0, self._session_id)
-            rows[n] = row
+    def _l2_file_key(self, md5_digest: bytes, file_size: int, file_type: int) -> str:
+        return f"{self._session_id}:file:{md5_digest.hex()}:{file_size}:{file_type}"
 
-        async with self._pool.acquire() as conn:  # type: asyncpg.Connection
-            await conn.executemany(query, rows)
+    async def _l2_get(self, key: str) -> Optional[bytes]:
+        # L2 cache is an optimization, its failures are not
+        try:
+            return await self._l2_cache.get(key)
+        except Exception:
+            logger.warning("L2 cache get has failed", exc_info=True)
+
+    async def _l2_set(self, key: str, value: bytes, ttl: float) -> None:
+        try:
+            await self._l2_cache.set(key, value, ttl)
+        except Exception:
+            logger.warning("L2 cache set has failed", exc_info=True)
+
+    async def _l2_delete(self, keys: List[str]) -> None:
+        try:
+            await self._l2_cache.delete(keys)
+        except Exception:
+            logger.warning("L2 cache invalidation has failed", exc_info=True)
 
     async def _get_entities_by_x(self, coln: str, colval: str) -> List[asyncpg.Record]:
         """
@@ -287,17 +1394,16 @@ class AsyncpgSession(BaseAsyncSession, ABC):
         if coln not in ALLOWED_ENTITY_IDENTIFIER_NAMES:
             raise RuntimeWarning(f"{coln!s} is not a valid tablename for entity")
 
-        query = """
-            select id, hash from asyncpg_telethon.entities
-            where 
-            entities.session_id = $1 and $2 = $3;
-        """
+        async def load():
+            async with self._acquire() as conn:  # type: asyncpg.Connection
+                return await self._statements.fetch(
+                    conn, f"entities_by_{coln}", self._session_id, colval
+                )
 
-        async with self._pool.acquire() as conn:  # type: asyncpg.Connection
-            return await conn.fetch(query, self._session_id, coln, colval,)
+        return await self._get_cached_entity_rows(coln, colval, load)
 
     async def get_entity_rows_by_phone(self, phone):
-        return await self._get_entities_by_x("phone", phone)
+        return await self._get_entities_by_x("phone", int(phone))
 
     async def get_entity_rows_by_username(self, username):
         return await self._get_entities_by_x("username", username)
@@ -306,88 +1412,203 @@ class AsyncpgSession(BaseAsyncSession, ABC):
         return await self._get_entities_by_x("name", name)
 
     async def get_entity_rows_by_id(self, id, exact=True):
-        async with self._pool.acquire() as conn:  # type: asyncpg.Connection
-            if exact:
-                return await conn.fetch(
-                    """
-                    select id, hash from asyncpg_telethon.entities
-                    where
-                    entities.session_id = $1 and id = $2
-                    """,
-                    self._session_id,
-                    id
-                )
+        if exact:
+            async def load():
+                async with self._acquire() as conn:  # type: asyncpg.Connection
+                    return await self._statements.fetch(
+                        conn, "entities_by_id", self._session_id, id
+                    )
 
-            return await conn.fetch(
-                """
-                select id, hash from asyncpg_telethon.entities
-                where
-                entities.session_id = $1 and id in ($2,$3,$4)
-                """,
-                self._session_id,
-                utils.get_peer_id(types.PeerUser(id)),
-                utils.get_peer_id(types.PeerChat(id)),
-                utils.get_peer_id(types.PeerChannel(id))
+            return await self._get_cached_entity_rows("id", id, load)
+
+        marked_ids = (
+            utils.get_peer_id(types.PeerUser(id)),
+            utils.get_peer_id(types.PeerChat(id)),
+            utils.get_peer_id(types.PeerChannel(id)),
+        )
+
+        misses = 0
+        for marked_id in marked_ids:
+            cached = self._entity_cache.get(("id", marked_id))
+            if cached is _NOT_FOUND:
+                misses += 1
+            elif cached is not None:
+                return [cached]
+        if misses == len(marked_ids):
+            return []
+
+        buffered = [
+            row for marked_id in marked_ids
+            for row in self._entity_buffer.find(self._session_id, "id", marked_id)
+        ]
+        if buffered:
+            return buffered
+
+        async with self._acquire() as conn:  # type: asyncpg.Connection
+            rows = await self._statements.fetch(
+                conn, "entities_by_ids", self._session_id, *marked_ids
             )
 
+        found = {row[0]: tuple(row) for row in rows}
+        for marked_id in marked_ids:
+            self._entity_cache.set(
+                ("id", marked_id),
+                found.get(marked_id, _NOT_FOUND),
+                ttl=None if marked_id in found else self._entity_negative_ttl
+            )
+        return rows
+
+    async def iter_entities(self, batch_size: int = 1000) -> AsyncIterator[Tuple]:
+        """
+        Yields (id, hash, username, phone, name) of every stored entity of
+        session, buffered ones are flushed first. Memory use is bounded by
+        ``batch_size``, so it suits tables of any size.
+
+        Example:
+            entities = session.iter_entities()
+            try:
+                async for entity_id, entity_hash, username, phone, name in entities:
+                    ...
+            finally:
+                await entities.aclose()  # releases connection if left early
+        """
+        await self._flush_entities()
+        async for row in iter_records(
+            self._acquire, self._statements.sql("entities_iter"), self._session_id,
+            batch_size=batch_size,
+        ):
+            yield row
+
+    async def iter_sessions(self, batch_size: int = 1000) -> AsyncIterator[str]:
+        """
+        Yields id of every stored session, not only of this one, once.
+        """
+        async for session_id, in iter_records(
+            self._acquire, self._statements.sql("sessions_list"), batch_size=batch_size
+        ):
+            yield session_id
+
     # File processing
 
+    async def _load_files(self) -> None:
+        """
+        Fills sent files index with one query, up to its size.
+        """
+        if self._files.maxsize <= 0:
+            return
+
+        async with self._acquire() as conn:  # type: asyncpg.Connection
+            rows = await self._statements.fetch(
+                conn, "sent_files_all", self._session_id, self._files.maxsize
+            )
+        for md5_digest, file_size, file_type, file_id, file_hash in rows:
+            self._files.set((bytes(md5_digest), file_size, file_type), (file_id, file_hash))
+
     async def get_file(self, md5_digest, file_size, cls):
-        query = """
-            select id, hash from asyncpg_telethon.sent_files 
-            where
-                sent_files.session_id = $1 
-                and 
-                md5_digest = $2
-                and
-                file_size = $3
-                and
-                type = $4;
-        """
-        async with self._pool.acquire() as conn:  # type: asyncpg.Connection
-            row = await conn.fetchrow(
-                query,
-                self._session_id,
-                md5_digest, file_size, _sftype(cls)
+        file_key = (md5_digest, file_size, _sftype(cls))
+        known = self._files.get(file_key)
+        if known is not None:
+            return _sent_file(cls, *known)
+
+        key = None
+        if self._l2_cache is not None:
+            key = self._l2_file_key(*file_key)
+            packed = await self._l2_get(key)
+            if packed is not None:
+                rows = _l2_unpack(packed)
+                if not rows:
+                    return None
+                self._files.set(file_key, rows[0])
+                return _sent_file(cls, *rows[0])
+
+        async with self._acquire() as conn:  # type: asyncpg.Connection
+            row = await self._statements.fetchrow(
+                conn, "sent_files_get", self._session_id, *file_key
             )
-            if row:
-                # Both allowed classes have (id, access_hash) as parameters
-                return cls(row.get("id"), row.get("hash"))
+
+        if key is not None:
+            await self._l2_set(
+                key, _l2_pack([tuple(row)] if row else []),
+                self._entity_cache.ttl if row else self._entity_negative_ttl
+            )
+        if row:
+            self._files.set(file_key, tuple(row))
+            return _sent_file(cls, *row)
+
+    async def get_shared_file(self, md5_digest: bytes, file_size: int) -> Optional[SharedFile]:
+        """
+        Tells which sessions have the file cached (see ``share_files``),
+        to be checked before uploading a file which this session doesn't have.
+        None - no session has it.
+        """
+        async with self._acquire() as conn:  # type: asyncpg.Connection
+            row = await self._statements.fetchrow(conn, "shared_files_get", md5_digest, file_size)
+        if row is None or not row[2]:
+            return None
+
+        file_type, hint, holders = row
+        return SharedFile(_sfconf_types[file_type], hint, tuple(holders))
 
     async def cache_file(self, md5_digest, file_size, instance):
-        if not isinstance(instance, _sfconf_keys):
-            raise TypeError('Cannot cache %s instance' % type(instance))
+        await self.cache_files(((md5_digest, file_size, instance),))
 
-        query = """
-            insert into asyncpg_telethon.sent_files(session_id,md5_digest,file_size,type,id,hash) 
-            values ($1,$2,$3,$4,$5,$6) 
-            on conflict(session_id, md5_digest, file_size, type) do 
-            update set md5_digest = $2, file_size = $3, type = $4, id = $5, hash = $6 
-            where sent_files.session_id = $1;
+    async def cache_files(self, files: Iterable[Tuple[bytes, int, Any]]):
         """
+        Batched form of ``cache_file``, accepts (md5_digest, file_size, instance) triples.
+        """
+        rows, shared = [], []
+        for md5_digest, file_size, instance in files:
+            if not isinstance(instance, _sfconf_keys):
+                raise TypeError('Cannot cache %s instance' % type(instance))
 
-        async with self._pool.acquire() as conn:  # type: asyncpg.Connection
-            await conn.execute(
-                query,
+            rows.append((
                 self._session_id,
                 md5_digest, file_size,
                 _sftype(type(instance)),
                 instance.id,
                 instance.access_hash
+            ))
+            if self.share_files:
+                shared.append((
+                    md5_digest, file_size, _sftype(type(instance)),
+                    file_hint(instance), self._session_id
+                ))
+
+        if not rows:
+            return
+
+        async with self._acquire() as conn:  # type: asyncpg.Connection
+            await upsert_rows(
+                conn, UPSERTS["sent_files"], rows, self.copy_threshold, self._statements
             )
+            if shared:
+                await self._statements.executemany(conn, "shared_files_upsert", shared)
+
+        for _, md5_digest, file_size, file_type, file_id, file_hash in rows:
+            self._files.set((md5_digest, file_size, file_type), (file_id, file_hash))
+
+        if self._l2_cache is not None:
+            await self._l2_delete([self._l2_file_key(*row[1:4]) for row in rows])
 
     async def delete(self):
-        async with self._pool.acquire() as conn:
+        """
+        Deletes stored session data. With partitioned layout deleting of
+        entities only touches the one partition that holds the session.
+        """
+        self._entity_buffer.discard(self._session_id)
+        self._update_states.clear()
+        self._dirty_update_states.clear()
+        self._entity_cache.clear()
+        self._fingerprints.clear()
+        self._files.clear()
+
+        async with self._acquire() as conn:  # type: asyncpg.Connection
             async with conn.transaction():
                 for table in TABLES:
-                    await conn.execute(
-                        """
-                        delete from asyncpg_telethon.$1
-                        where
-                        $1.session_id = $2;
-                        """,
-                        table, self._session_id
-                    )
+                    await self._statements.execute(conn, f"{table}_delete", self._session_id)
+                if self.share_files:
+                    await self._statements.execute(conn, "shared_files_forget", self._session_id)
+                await self._notify(conn, "delete")
 
     async def get_input_entity(self, key):
         try:
@@ -426,7 +1647,7 @@ class AsyncpgSession(BaseAsyncSession, ABC):
             result = await self.get_entity_rows_by_name(key)
 
         if result:
-            entity_id, entity_hash = result  # unpack resulting tuple
+            entity_id, entity_hash = result[0]  # unpack first resulting row
             entity_id, kind = utils.resolve_id(entity_id)
             # removes the mark and returns type of entity
             if kind == types.PeerUser:
@@ -441,13 +1662,29 @@ class AsyncpgSession(BaseAsyncSession, ABC):
     async def close(self, timeout: int = None):
         """
         Implements connection pool closing.
+        Shared pool (see ``with_pool``) is left open for its owner.
 
         :param timeout: Ignored in this implementation
         """
-        await self._pool.close()
+        await self.save()
+        if self._listener is not None:
+            await self._listener.unsubscribe(
+                self._notify_channel, self._session_id, self._on_notification
+            )
+            self._listener = None
+        if self._owns_pool:
+            forget_pool(self._pool)
+            await close_listener(self._pool)
+            await self._pool.close()
+        else:
+            # shared pool may have been closed by its owner
+            forget_pool()
         self.started = False
 
     async def save(self):
         """
-        AsyncpgSession does not define save metthod.
+        Writes changed session row, update states and buffered entities to the database.
         """
+        await self._update_session_table()
+        await self._flush_update_states()
+        await self._flush_entities()
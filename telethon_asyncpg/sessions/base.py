@@ -3,12 +3,72 @@ todo(refactor): make more abstract BaseAsyncSession
 Session shouldn't know anything about tl/* even session's private interface
 """
 
+import math
 from abc import ABC
 
 from ..sessions.abstract import AbstractAsyncSession
 from telethon import utils
 from telethon.tl import types
 
+# Ids out of range are left to utils, which fixes them up
+_MAX_ID = 0x7fffffff
+
+
+def _user_row(session, e):
+    if e.min or e.access_hash is None:
+        return
+    if e.first_name and e.last_name:
+        name = '{} {}'.format(e.first_name, e.last_name)
+    else:
+        name = e.first_name or e.last_name or None
+    return session._entity_values_to_row(
+        e.id, e.access_hash, e.username.lower() if e.username else None, e.phone, name
+    )
+
+
+def _chat_row(session, e):
+    if not 0 < e.id <= _MAX_ID:
+        return session._entity_to_row(e)
+    # utils.get_display_name only knows title of Chat, not of ChatForbidden
+    name = (e.title or None) if e.__class__ is types.Chat else None
+    return session._entity_values_to_row(-e.id, 0, None, None, name)
+
+
+def _channel_marked_id(channel_id):
+    # the same as utils.get_peer_id(types.PeerChannel(channel_id))
+    return -(channel_id + pow(10, math.floor(math.log10(channel_id) + 3)))
+
+
+def _channel_row(session, e):
+    if e.min or e.access_hash is None:
+        return
+    if not 0 < e.id <= _MAX_ID:
+        return session._entity_to_row(e)
+    return session._entity_values_to_row(
+        _channel_marked_id(e.id), e.access_hash,
+        e.username.lower() if e.username else None, None, e.title or None
+    )
+
+
+def _channel_forbidden_row(session, e):
+    if not 0 < e.id <= _MAX_ID:
+        return session._entity_to_row(e)
+    return session._entity_values_to_row(
+        _channel_marked_id(e.id), e.access_hash, None, None, None
+    )
+
+
+# Concrete class -> (peer kind, row builder), the fast path of ``_entities_to_rows``.
+# Builders give the same rows as ``_entity_to_row`` without generic utils calls.
+_ENTITY_ROW_BUILDERS = {
+    types.User: (types.PeerUser, _user_row),
+    types.Chat: (types.PeerChat, _chat_row),
+    types.ChatForbidden: (types.PeerChat, _chat_row),
+    types.ChatEmpty: (types.PeerChat, _chat_row),
+    types.Channel: (types.PeerChannel, _channel_row),
+    types.ChannelForbidden: (types.PeerChannel, _channel_forbidden_row),
+}
+
 
 class BaseAsyncSession(AbstractAsyncSession, ABC):
     def __init__(self):
@@ -78,23 +138,44 @@ class BaseAsyncSession(AbstractAsyncSession, ABC):
             marked_id, p_hash, username, phone, name
         )
 
-    def _entities_to_rows(self, tlo):
+    @staticmethod
+    def _collect_entities(tlo):
         if not isinstance(tlo, types.TLObject) and utils.is_list_like(tlo):
             # This may be a list of users already for instance
-            entities = tlo
-        else:
-            entities = []
-            if hasattr(tlo, 'user'):
-                entities.append(tlo.user)
-            if hasattr(tlo, 'chats') and utils.is_list_like(tlo.chats):
-                entities.extend(tlo.chats)
-            if hasattr(tlo, 'users') and utils.is_list_like(tlo.users):
-                entities.extend(tlo.users)
+            return tlo if isinstance(tlo, (list, tuple)) else list(tlo)
+
+        entities = []
+        if hasattr(tlo, 'user'):
+            entities.append(tlo.user)
+        if hasattr(tlo, 'chats') and utils.is_list_like(tlo.chats):
+            entities.extend(tlo.chats)
+        if hasattr(tlo, 'users') and utils.is_list_like(tlo.users):
+            entities.extend(tlo.users)
+        return entities
 
+    def _entities_to_rows(self, tlo):
+        entities = self._collect_entities(tlo)
         rows = []  # Rows to add (id, hash, username, phone, name)
-        for e in entities:
-            row = self._entity_to_row(e)
+        # peer kind -> ids, entity ids are kept as they are, no key is allocated
+        seen = {types.PeerUser: set(), types.PeerChat: set(), types.PeerChannel: set()}
+        # the last usable version of an entity wins, duplicates before it are not built
+        for e in reversed(entities):
+            builder = _ENTITY_ROW_BUILDERS.get(e.__class__)
+            if builder is None:
+                row = self._entity_to_row(e)
+                if row:
+                    rows.append(row)
+                continue
+
+            kind, build = builder
+            ids = seen[kind]
+            if e.id in ids:
+                continue
+            row = build(self, e)
             if row:
+                ids.add(e.id)
                 rows.append(row)
+
+        rows.reverse()
         return rows
 
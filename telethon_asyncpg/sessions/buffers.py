@@ -0,0 +1,109 @@
+"""
+In-memory write buffers used by sessions to keep database
+round trips out of the request path.
+"""
+
+import time
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+# Position of each column inside a buffered entity row, which is
+# (session_id, id, hash, username, phone, name)
+_ENTITY_COLUMNS = {"id": 1, "hash": 2, "username": 3, "phone": 4, "name": 5}
+
+
+class EntityBuffer:
+    """
+    Write-behind buffer for entity rows.
+
+    Rows are merged by ``(session_id, id)`` so the last seen version of
+    an entity wins, and are handed out as a single batch by ``drain``.
+    """
+
+    def __init__(self, max_size: int = 1000, max_delay: float = 5.0):
+        """
+        :param max_size: amount of buffered rows that asks for an early flush
+        :param max_delay: seconds the oldest buffered row may wait for a flush
+        """
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self._rows: Dict[Tuple[str, int], Sequence[Any]] = {}
+        self._since: Optional[float] = None
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def __bool__(self) -> bool:
+        return bool(self._rows)
+
+    def add(self, rows: Iterable[Sequence[Any]]) -> None:
+        """
+        Merges rows of (session_id, id, hash, username, phone, name) into buffer.
+        """
+        for row in rows:
+            self._rows[(row[0], row[1])] = row
+
+        if self._rows and self._since is None:
+            self._since = time.monotonic()
+
+    def should_flush(self) -> bool:
+        if not self._rows:
+            return False
+
+        return (
+            len(self._rows) >= self.max_size
+            or time.monotonic() - self._since >= self.max_delay
+        )
+
+    def drain(self) -> List[Sequence[Any]]:
+        """
+        Takes every buffered row out of the buffer.
+        """
+        rows = list(self._rows.values())
+        self._rows.clear()
+        self._since = None
+        return rows
+
+    def discard(self, session_id: str) -> None:
+        """
+        Drops buffered rows of one session, rows of other sessions are kept.
+        """
+        for key in [key for key in self._rows if key[0] == session_id]:
+            del self._rows[key]
+
+        if not self._rows:
+            self._since = None
+
+    def restore(self, rows: Iterable[Sequence[Any]]) -> None:
+        """
+        Puts back rows of a failed flush without overriding newer versions.
+        """
+        for row in rows:
+            self._rows.setdefault((row[0], row[1]), row)
+
+        if self._rows and self._since is None:
+            self._since = time.monotonic()
+
+    def get(self, session_id: str, entity_id: int) -> Optional[Sequence[Any]]:
+        return self._rows.get((session_id, entity_id))
+
+    def find(self, session_id: str, coln: str, colval: Any) -> List[Tuple[int, int]]:
+        """
+        Looks up not yet flushed rows, returns (id, hash) pairs.
+        """
+        if coln == "id":
+            row = self._rows.get((session_id, colval))
+            return [(row[1], row[2])] if row else []
+
+        index = _ENTITY_COLUMNS[coln]
+        if coln == "name":
+            # names are compared case-insensitively, as in the database
+            colval = colval.lower()
+            return [
+                (row[1], row[2]) for row in self._rows.values()
+                if row[0] == session_id and row[index] and row[index].lower() == colval
+            ]
+
+        return [
+            (row[1], row[2]) for row in self._rows.values()
+            if row[0] == session_id and row[index] == colval
+        ]
@@ -0,0 +1,93 @@
+"""
+Small in-process caches used by sessions.
+"""
+
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+
+class LRUCache:
+    """
+    Bounded mapping which evicts least recently used keys.
+
+    Counts ``hits`` and ``misses`` of ``get``.
+    """
+
+    def __init__(self, maxsize: int = 10000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data: 'OrderedDict[Hashable, Any]' = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._data
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        if self.maxsize <= 0:
+            return
+
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Optional[Any]:
+        return self._data.pop(key, default)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def discard(self, predicate: Callable[[Hashable, Any], bool]) -> None:
+        """
+        Removes every entry which (key, value) satisfies predicate.
+        """
+        for key in [key for key, value in self._data.items() if predicate(key, value)]:
+            del self._data[key]
+
+
+class TTLCache(LRUCache):
+    """
+    ``LRUCache`` which values also expire ``ttl`` seconds after being set.
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 300.0):
+        super().__init__(maxsize)
+        self.ttl = ttl
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.get(key)
+        if item is None or item[0] <= time.monotonic():
+            if item is not None:
+                del self._data[key]
+            self.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        super().set(key, (expires, value))
+
+    def pop(self, key: Hashable, default: Any = None) -> Optional[Any]:
+        item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def discard(self, predicate: Callable[[Hashable, Any], bool]) -> None:
+        super().discard(lambda key, item: predicate(key, item[1]))
@@ -0,0 +1,207 @@
+"""
+Second level caches shared by processes serving the same sessions.
+"""
+
+import asyncio
+import time
+from abc import ABC, abstractmethod
+from typing import Dict, Iterable, Optional, Tuple, Union
+
+
+class AbstractL2Cache(ABC):
+    """
+    Byte keyed and valued cache which sits between in-process caches of
+    session and postgres. Implementations must be safe to share between sessions.
+    """
+
+    @abstractmethod
+    async def get(self, key: str) -> Optional[bytes]:
+        """
+        Returns value of key or None if there is no such (or it has expired).
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    async def set(self, key: str, value: bytes, ttl: float) -> None:
+        """
+        Sets value of key which expires in ``ttl`` seconds.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    async def delete(self, keys: Iterable[str]) -> None:
+        """
+        Invalidates keys.
+        """
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        """
+        Frees used resources, if any.
+        """
+
+
+class InMemoryL2Cache(AbstractL2Cache):
+    """
+    Process local ``AbstractL2Cache``, mostly for tests.
+    """
+
+    def __init__(self):
+        self.data: Dict[str, Tuple[float, bytes]] = {}
+
+    async def get(self, key: str) -> Optional[bytes]:
+        item = self.data.get(key)
+        if item is None or item[0] <= time.monotonic():
+            self.data.pop(key, None)
+            return None
+        return item[1]
+
+    async def set(self, key: str, value: bytes, ttl: float) -> None:
+        self.data[key] = (time.monotonic() + ttl, value)
+
+    async def delete(self, keys: Iterable[str]) -> None:
+        for key in keys:
+            self.data.pop(key, None)
+
+
+class RedisError(Exception):
+    """
+    Error reply of the server.
+    """
+
+
+def encode_command(*args: Union[str, bytes, int]) -> bytes:
+    """
+    Encodes command as RESP array of bulk strings.
+    """
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if isinstance(arg, str):
+            arg = arg.encode()
+        elif isinstance(arg, int):
+            arg = b"%d" % arg
+        parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(parts)
+
+
+async def read_reply(reader: asyncio.StreamReader):
+    """
+    Reads one RESP reply. Error replies are raised as ``RedisError``.
+    """
+    line = await reader.readuntil(b"\r\n")
+    kind, payload = line[:1], line[1:-2]
+    if kind == b"+":
+        return payload
+    if kind == b"-":
+        raise RedisError(payload.decode(errors="replace"))
+    if kind == b":":
+        return int(payload)
+    if kind == b"$":
+        length = int(payload)
+        if length < 0:
+            return None
+        return (await reader.readexactly(length + 2))[:-2]
+    if kind == b"*":
+        length = int(payload)
+        if length < 0:
+            return None
+        return [await read_reply(reader) for _ in range(length)]
+    raise RedisError(f"Unexpected reply {line!r}")
+
+
+class RedisL2Cache(AbstractL2Cache):
+    """
+    ``AbstractL2Cache`` on top of server speaking redis protocol (RESP).
+
+    Uses single connection, commands are sent one at a time. Connection
+    is opened on first use and reopened after failure. Commands which are
+    not answered in ``timeout`` seconds raise ``asyncio.TimeoutError``,
+    which sessions take as a cache miss.
+
+    Example:
+        session = AsyncpgSession(pgconf, l2_cache=RedisL2Cache("localhost"))
+    """
+
+    def __init__(
+        self,
+        host: str = "localhost",
+        port: int = 6379,
+        db: int = 0,
+        password: Optional[str] = None,
+        prefix: str = "telethon:",
+        timeout: Optional[float] = 1.0,
+    ):
+        """
+        :param host: server host
+        :param port: server port
+        :param db: database number to SELECT
+        :param password: AUTH password, if required
+        :param prefix: prepended to every key
+        :param timeout: seconds a command may take, including connecting
+            and waiting for preceding commands; None waits forever
+        """
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.prefix = prefix
+        self.timeout = timeout
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._lock = asyncio.Lock()
+
+    async def _connect(self) -> None:
+        try:
+            self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+            if self.password is not None:
+                await self._call("AUTH", self.password)
+            if self.db:
+                await self._call("SELECT", self.db)
+        except BaseException:
+            # half set up connection would talk to the wrong database
+            await self._drop()
+            raise
+
+    async def _call(self, *args: Union[str, bytes, int]):
+        self._writer.write(encode_command(*args))
+        await self._writer.drain()
+        return await read_reply(self._reader)
+
+    async def execute(self, *args: Union[str, bytes, int]):
+        """
+        Sends command and returns its reply.
+        """
+        return await asyncio.wait_for(self._execute(*args), self.timeout)
+
+    async def _execute(self, *args: Union[str, bytes, int]):
+        async with self._lock:
+            try:
+                if self._writer is None:
+                    await self._connect()
+                return await self._call(*args)
+            except RedisError:
+                raise
+            except BaseException:
+                # state of connection is unknown, start over next time
+                await self._drop()
+                raise
+
+    async def _drop(self) -> None:
+        writer, self._reader, self._writer = self._writer, None, None
+        if writer is not None:
+            writer.close()
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return await self.execute("GET", self.prefix + key)
+
+    async def set(self, key: str, value: bytes, ttl: float) -> None:
+        await self.execute("SET", self.prefix + key, value, "PX", max(1, int(ttl * 1000)))
+
+    async def delete(self, keys: Iterable[str]) -> None:
+        keys = [self.prefix + key for key in keys]
+        if keys:
+            await self.execute("DEL", *keys)
+
+    async def close(self) -> None:
+        async with self._lock:
+            await self._drop()
@@ -0,0 +1,140 @@
+"""
+Many sessions on top of one pool.
+"""
+
+import asyncio
+import weakref
+from typing import Any, AsyncIterator, Dict, Optional, Union
+
+import asyncpg
+
+from ..sessions.asyncpg import (
+    AsyncpgSession,
+    ensure_schema,
+    flush_entity_buffer,
+    forget_pool,
+    iter_records,
+    statements,
+    unprepared_statements,
+)
+from ..sessions.buffers import EntityBuffer
+from ..sessions.notify import close_listener
+
+
+class SessionManager:
+    """
+    Owns asyncpg pool shared by many sessions.
+
+    Schema is bootstrapped once per manager, sessions handed out by ``session``
+    skip it on start and buffer their entities into one shared buffer, so a
+    single flush writes entities of every session at once.
+
+    Example:
+        manager = SessionManager(dsn)
+        await manager.start()
+        client = TelegramClient(manager.session("bot-1"), api_id, api_hash)
+        ...
+        await manager.close()
+    """
+
+    def __init__(
+        self,
+        asyncpg_conf: Union[str, Dict[str, Any]],
+        entity_flush_size: int = 5000,
+        entity_flush_interval: float = 5.0,
+        pgbouncer: bool = False,
+        partitions: Optional[int] = None,
+        **session_options: Any
+    ):
+        """
+        :param asyncpg_conf: asyncpg.create_pool configs
+        :param entity_flush_size: buffered entities count (of all sessions) which triggers an early flush
+        :param entity_flush_interval: max seconds entities may stay buffered before flush
+        :param pgbouncer: True - don't use prepared statements (pgbouncer transaction mode)
+        :param partitions: create entities table hash partitioned by session into that many tables
+        :param session_options: other AsyncpgSession initializer options for every session
+        """
+        self._conf = dict(asyncpg_conf) if isinstance(asyncpg_conf, dict) else {"dsn": asyncpg_conf}
+        self._statements = unprepared_statements if pgbouncer else statements
+        if pgbouncer:
+            self._conf.setdefault("statement_cache_size", 0)
+
+        self._session_options = dict(session_options, pgbouncer=pgbouncer)
+        self._copy_threshold = session_options.get("copy_threshold", 100)
+        self._partitions = partitions
+        self._pool: Optional[asyncpg.pool.Pool] = None
+        self._lock = asyncio.Lock()
+        self._entity_buffer = EntityBuffer(entity_flush_size, entity_flush_interval)
+        self._flush_lock = asyncio.Lock()
+        self._sessions: 'weakref.WeakValueDictionary[str, AsyncpgSession]' = weakref.WeakValueDictionary()
+
+    @property
+    def pool(self) -> asyncpg.pool.Pool:
+        if self._pool is None:
+            raise RuntimeError("SessionManager is not started")
+        return self._pool
+
+    async def start(self) -> None:
+        """
+        Opens the pool and bootstraps the schema, does nothing if already started.
+        """
+        async with self._lock:
+            if self._pool is not None:
+                return
+
+            pool = await asyncpg.create_pool(**self._conf)
+            async with pool.acquire() as conn:  # type: asyncpg.Connection
+                await ensure_schema(pool, conn, self._partitions, not self._statements.prepare)
+            self._pool = pool
+
+    def session(self, session_id: str) -> AsyncpgSession:
+        """
+        Returns session view for ``session_id``, the same one while it is in use.
+        """
+        session = self._sessions.get(session_id)
+        if session is not None:
+            return session
+
+        session = AsyncpgSession.with_pool(
+            self.pool, lambda: session_id, **self._session_options
+        )
+        session._schema_ready = True
+        session._entity_buffer = self._entity_buffer
+        session._flush_lock = self._flush_lock
+        self._sessions[session_id] = session
+        return session
+
+    async def iter_sessions(self, batch_size: int = 1000) -> AsyncIterator[str]:
+        """
+        Yields id of every stored session once.
+        """
+        async for session_id, in iter_records(
+            self.pool.acquire, self._statements.sql("sessions_list"), batch_size=batch_size
+        ):
+            yield session_id
+
+    async def flush(self) -> None:
+        """
+        Writes buffered entities of all sessions in one batch.
+        """
+        await flush_entity_buffer(
+            self.pool.acquire, self._entity_buffer, self._flush_lock,
+            self._copy_threshold, self._statements, self._session_options.get("notify_channel"),
+            self._session_options.get("l2_cache"),
+        )
+
+    async def close(self) -> None:
+        """
+        Saves every session and closes the pool.
+        """
+        if self._pool is None:
+            return
+
+        # session rows and update states are kept by views until they are saved
+        for session in list(self._sessions.values()):
+            await session.save()
+        await self.flush()
+        forget_pool(self._pool)
+        await close_listener(self._pool)
+        await self._pool.close()
+        self._pool = None
@@ -0,0 +1,167 @@
+"""
+Cross-process invalidation of session state with postgres LISTEN/NOTIFY.
+"""
+
+import asyncio
+import json
+import logging
+import uuid
+from typing import Any, Callable, Dict, Optional, Set
+
+import asyncpg
+
+logger = logging.getLogger(__name__)
+
+# Identifies notifications of this process, which listeners skip
+ORIGIN = uuid.uuid4().hex
+# Postgres refuses payloads of 8000 bytes and longer
+MAX_PAYLOAD = 7900
+RECONNECT_DELAY = 5.0
+
+
+def make_payload(session_id: str, kind: str, **fields: Any) -> str:
+    """
+    Encodes notification about ``kind`` change of session ``session_id``.
+    """
+    return json.dumps({"s": session_id, "k": kind, "o": ORIGIN, **fields}, separators=(",", ":"))
+
+
+class Listener:
+    """
+    Dedicated pooled connection which LISTENs on channels for sessions of one pool.
+
+    Callbacks are subscribed by (channel, session_id) and called with decoded
+    notification of other processes. Connection is restored if it is lost,
+    notifications sent meanwhile are missed, and is released back to the pool
+    when the last subscriber leaves.
+    """
+
+    def __init__(self, pool: asyncpg.pool.Pool):
+        self._pool = pool
+        self._conn: Optional[asyncpg.Connection] = None
+        self._lock = asyncio.Lock()
+        self._subscribers: Dict[str, Dict[str, Set[Callable[[Dict[str, Any]], None]]]] = {}
+        self._reconnect: Optional[asyncio.Future] = None
+        self._closed = False
+
+    async def subscribe(
+        self, channel: str, session_id: str, callback: Callable[[Dict[str, Any]], None]
+    ) -> None:
+        async with self._lock:
+            # listener released by its last subscriber is registered again
+            _listeners.setdefault(id(self._pool), self)
+            if self._conn is None:
+                await self._connect()
+            if channel not in self._subscribers:
+                await self._conn.add_listener(channel, self._dispatch)
+            self._subscribers.setdefault(channel, {}).setdefault(session_id, set()).add(callback)
+
+    async def unsubscribe(
+        self, channel: str, session_id: str, callback: Callable[[Dict[str, Any]], None]
+    ) -> None:
+        async with self._lock:
+            sessions = self._subscribers.get(channel, {})
+            callbacks = sessions.get(session_id, set())
+            callbacks.discard(callback)
+            if not callbacks:
+                sessions.pop(session_id, None)
+            if not sessions and channel in self._subscribers:
+                del self._subscribers[channel]
+                if self._conn is not None:
+                    await self._conn.remove_listener(channel, self._dispatch)
+            if self.empty:
+                # pool can't be closed while the connection is held
+                if _listeners.get(id(self._pool)) is self:
+                    del _listeners[id(self._pool)]
+                await self._release()
+
+    @property
+    def empty(self) -> bool:
+        return not self._subscribers
+
+    async def _connect(self) -> None:
+        conn = await self._pool.acquire()
+        try:
+            for channel in self._subscribers:
+                await conn.add_listener(channel, self._dispatch)
+            conn.add_termination_listener(self._terminated)
+        except BaseException:
+            await self._pool.release(conn)
+            raise
+        self._conn = conn
+
+    def _terminated(self, connection: asyncpg.Connection) -> None:
+        if self._closed:
+            return
+        logger.warning("Notification listener connection is lost, reconnecting")
+        self._conn = None
+        if self._reconnect is None or self._reconnect.done():
+            self._reconnect = asyncio.ensure_future(self._restore())
+
+    async def _restore(self) -> None:
+        while not self._closed:
+            try:
+                async with self._lock:
+                    if self._conn is None and not self._closed and self._subscribers:
+                        await self._connect()
+                return
+            except Exception:
+                logger.exception("Notification listener has failed to reconnect")
+                await asyncio.sleep(RECONNECT_DELAY)
+
+    def _dispatch(self, connection: asyncpg.Connection, pid: int, channel: str, payload: str) -> None:
+        try:
+            message = json.loads(payload)
+        except ValueError:
+            logger.warning(f"Malformed notification {payload!r} on {channel}")
+            return
+
+        if message.get("o") == ORIGIN:
+            return
+
+        for callback in list(self._subscribers.get(channel, {}).get(message.get("s"), ())):
+            try:
+                callback(message)
+            except Exception:
+                logger.exception("Notification callback has failed")
+
+    async def _release(self) -> None:
+        conn, self._conn = self._conn, None
+        channels = list(self._subscribers)
+        self._subscribers.clear()
+        if conn is not None:
+            conn.remove_termination_listener(self._terminated)
+            # pooled connection must not be released with listeners attached
+            for channel in channels:
+                await conn.remove_listener(channel, self._dispatch)
+            await self._pool.release(conn)
+
+    async def close(self) -> None:
+        self._closed = True
+        if self._reconnect is not None:
+            self._reconnect.cancel()
+        async with self._lock:
+            await self._release()
+
+
+# id(pool) -> listener, one connection per pool (pools can't be weakly referenced)
+_listeners: Dict[int, Listener] = {}
+
+
+def get_listener(pool: asyncpg.pool.Pool) -> Listener:
+    """
+    Returns listener of pool, creates one if there is none.
+    """
+    listener = _listeners.get(id(pool))
+    if listener is None:
+        listener = _listeners[id(pool)] = Listener(pool)
+    return listener
+
+
+async def close_listener(pool: asyncpg.pool.Pool) -> None:
+    """
+    Releases listener connection of pool, must be done before the pool is closed.
+    """
+    listener = _listeners.pop(id(pool), None)
+    if listener is not None:
+        await listener.close()
@@ -0,0 +1,80 @@
+"""
+Registry of named SQL statements prepared once per connection.
+"""
+
+import time
+from typing import Any, Dict, Iterable, Mapping, Sequence
+
+import asyncpg
+
+
+class StatementRegistry:
+    """
+    Keeps named SQL statements, prepared by statement cache of every connection.
+
+    Registry is safe to share between sessions and pools. Statements are run
+    by their SQL, so asyncpg prepares them on first use per raw connection and
+    keeps them in its own cache across pool acquires (``statement_cache_size``
+    must fit every statement). ``prepare=False`` marks registry used together
+    with ``statement_cache_size=0`` pool option behind pgbouncer in transaction
+    mode, where consecutive statements may run on different server connections.
+    """
+
+    def __init__(self, statements: Mapping[str, str], prepare: bool = True):
+        """
+        :param statements: mapping of statement name to its SQL
+        :param prepare: False - statements are not prepared (pgbouncer transaction mode)
+        """
+        self.prepare = prepare
+        self._sql = dict(statements)
+        self._timings: Dict[str, list] = {name: [0, 0.0] for name in self._sql}
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._sql
+
+    def sql(self, name: str) -> str:
+        return self._sql[name]
+
+    @property
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """
+        Amount of calls and total seconds spent per statement.
+        """
+        return {
+            name: {"calls": calls, "total": total}
+            for name, (calls, total) in self._timings.items()
+            if calls
+        }
+
+    async def _run(self, connection: asyncpg.Connection, name: str, method: str, args: Sequence[Any]) -> Any:
+        started = time.perf_counter()
+        try:
+            # outside of transaction asyncpg prepares statement invalidated by
+            # schema change again itself
+            return await getattr(connection, method)(self._sql[name], *args)
+        finally:
+            timing = self._timings[name]
+            timing[0] += 1
+            timing[1] += time.perf_counter() - started
+
+    async def fetch(self, connection: asyncpg.Connection, name: str, *args: Any) -> Any:
+        return await self._run(connection, name, "fetch", args)
+
+    async def fetchrow(self, connection: asyncpg.Connection, name: str, *args: Any) -> Any:
+        return await self._run(connection, name, "fetchrow", args)
+
+    async def fetchval(self, connection: asyncpg.Connection, name: str, *args: Any) -> Any:
+        return await self._run(connection, name, "fetchval", args)
+
+    async def execute(self, connection: asyncpg.Connection, name: str, *args: Any) -> None:
+        await self._run(connection, name, "execute", args)
+
+    async def executemany(self, connection: asyncpg.Connection, name: str, args: Iterable[Sequence[Any]]) -> None:
+        started = time.perf_counter()
+        try:
+            # connection's own statement cache prepares it, works for every asyncpg version
+            await connection.executemany(self._sql[name], args)
+        finally:
+            timing = self._timings[name]
+            timing[0] += 1
+            timing[1] += time.perf_counter() - started
@@ -0,0 +1,290 @@
+"""
+Streaming transfer of sessions between telethon's SQLite files and "asyncpg_telethon".
+"""
+
+import asyncio
+import functools
+import os
+import sqlite3
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Mapping, Optional, Sequence, Tuple, TypeVar
+
+import asyncpg
+
+from ..sessions.asyncpg import (
+    TELETHON_SQLITE_CURRENT_VERSION,
+    UPSERTS,
+    ensure_schema,
+    statements,
+    upsert_rows,
+)
+from ..sessions.statements import StatementRegistry
+
+SQLITE_EXTENSION = ".session"
+
+# Schema of telethon's SQLite session, version TELETHON_SQLITE_CURRENT_VERSION
+SQLITE_SCHEMA = (
+    "create table version (version integer primary key)",
+    """create table sessions (
+        dc_id integer primary key,
+        server_address text,
+        port integer,
+        auth_key blob,
+        takeout_id integer
+    )""",
+    """create table entities (
+        id integer primary key,
+        hash integer not null,
+        username text,
+        phone integer,
+        name text
+    )""",
+    """create table sent_files (
+        md5_digest blob,
+        file_size integer,
+        type integer,
+        id integer,
+        hash integer,
+        primary key(md5_digest, file_size, type)
+    )""",
+    """create table update_state (
+        id integer primary key,
+        pts integer,
+        qts integer,
+        date integer,
+        seq integer
+    )""",
+)
+
+# Columns of tables transferred in batches, the same in both databases except session_id
+TABLE_COLUMNS = {
+    "entities": ("id", "hash", "username", "phone", "name"),
+    "sent_files": ("md5_digest", "file_size", "type", "id", "hash"),
+    "update_state": ("id", "pts", "qts", "date", "seq"),
+}
+SESSION_COLUMNS = ("dc_id", "server_address", "port", "auth_key", "takeout_id")
+
+T = TypeVar("T")
+
+
+def _phone(row: Sequence[Any]) -> Sequence[Any]:
+    # SQLite keeps what it's given, "asyncpg_telethon" phone is bigint
+    entity_id, entity_hash, username, phone, name = row
+    return entity_id, entity_hash, username, int(phone) if phone else None, name
+
+
+async def _in_thread(func: Callable[..., T], *args: Any) -> T:
+    return await asyncio.get_event_loop().run_in_executor(None, functools.partial(func, *args))
+
+
+def _connect_sqlite(path: str) -> sqlite3.Connection:
+    # one operation at a time is run by executor threads
+    return sqlite3.connect(path, check_same_thread=False)
+
+
+def session_id_of(path: str) -> str:
+    """
+    Session id for file imported without one, its name without ``.session``.
+    """
+    name = os.path.basename(path)
+    return name[:-len(SQLITE_EXTENSION)] if name.endswith(SQLITE_EXTENSION) else name
+
+
+async def import_sqlite(
+    pool: asyncpg.pool.Pool,
+    path: str,
+    session_id: Optional[str] = None,
+    batch_size: int = 5000,
+    registry: StatementRegistry = statements,
+) -> str:
+    """
+    Copies SQLite session file into "asyncpg_telethon" in one transaction.
+
+    Rows are read by ``batch_size`` and copied into postgres by COPY batch by
+    batch, so memory use does not depend on the size of the file. Rows which
+    already exist are overridden.
+
+    :param pool: pool of target database, schema is created if needed
+    :param path: path to telethon's ``.session`` file
+    :param session_id: id of imported session, name of file by default
+    :param batch_size: rows read and copied at once
+    :param registry: ``unprepared_statements`` behind pgbouncer
+    :return: session id
+    """
+    session_id = session_id or session_id_of(path)
+    sqlite_conn = await _in_thread(_connect_sqlite, path)
+    try:
+        version = await _in_thread(_sqlite_version, sqlite_conn)
+        if version != TELETHON_SQLITE_CURRENT_VERSION:
+            raise ValueError(
+                f"{path} is of version {version}, only {TELETHON_SQLITE_CURRENT_VERSION} is supported, "
+                f"open it with telethon to upgrade"
+            )
+
+        async with pool.acquire() as conn:  # type: asyncpg.Connection
+            await ensure_schema(pool, conn, pgbouncer=not registry.prepare)
+            async with conn.transaction():
+                for row in await _in_thread(_fetch_all, sqlite_conn, "sessions", SESSION_COLUMNS):
+                    await registry.execute(conn, "sessions_upsert", session_id, *row)
+
+                for table, columns in TABLE_COLUMNS.items():
+                    cursor = await _in_thread(_select, sqlite_conn, table, columns)
+                    while True:
+                        rows = await _in_thread(cursor.fetchmany, batch_size)
+                        if not rows:
+                            break
+                        if table == "entities":
+                            rows = map(_phone, rows)
+                        # copy_threshold=0, every batch goes through COPY
+                        await upsert_rows(
+                            conn, UPSERTS[table], [(session_id, *row) for row in rows], 0, registry
+                        )
+    finally:
+        await _in_thread(sqlite_conn.close)
+
+    return session_id
+
+
+def _sqlite_version(sqlite_conn: sqlite3.Connection) -> Optional[int]:
+    try:
+        row = sqlite_conn.execute("select version from version").fetchone()
+    except sqlite3.OperationalError:  # not a session file
+        return None
+    return row and row[0]
+
+
+def _select(sqlite_conn: sqlite3.Connection, table: str, columns: Sequence[str]) -> sqlite3.Cursor:
+    return sqlite_conn.execute(f"select {', '.join(columns)} from {table}")
+
+
+def _fetch_all(sqlite_conn: sqlite3.Connection, table: str, columns: Sequence[str]) -> List[Tuple]:
+    return _select(sqlite_conn, table, columns).fetchall()
+
+
+async def export_sqlite(
+    pool: asyncpg.pool.Pool,
+    session_id: str,
+    path: str,
+    batch_size: int = 5000,
+) -> None:
+    """
+    Writes session of "asyncpg_telethon" into a new SQLite session file.
+
+    Rows are read with server-side cursors by ``batch_size`` and written
+    batch by batch. File is written under a temporary name and moved to
+    ``path`` once complete.
+
+    :param pool: pool of source database
+    :param session_id: id of exported session
+    :param path: path of ``.session`` file to create, must not exist
+    :param batch_size: rows fetched and written at once
+    """
+    if os.path.exists(path):
+        raise FileExistsError(path)
+
+    partial = path + ".partial"
+    sqlite_conn = await _in_thread(_create_sqlite, partial)
+    try:
+        async with pool.acquire() as conn:  # type: asyncpg.Connection
+            # cursors only live inside of transaction
+            async with conn.transaction(readonly=True, isolation="repeatable_read"):
+                for table, columns in (("sessions", SESSION_COLUMNS), *TABLE_COLUMNS.items()):
+                    batch = []
+                    cursor = conn.cursor(
+                        f"select {', '.join(columns)} from asyncpg_telethon.{table} "
+                        f"where session_id = $1;",
+                        session_id, prefetch=batch_size,
+                    )
+                    async for record in cursor:
+                        batch.append(tuple(record))
+                        if len(batch) >= batch_size:
+                            await _in_thread(_insert, sqlite_conn, table, columns, batch)
+                            batch = []
+                    if batch:
+                        await _in_thread(_insert, sqlite_conn, table, columns, batch)
+
+        await _in_thread(sqlite_conn.commit)
+    except BaseException:
+        await _in_thread(sqlite_conn.close)
+        os.remove(partial)
+        raise
+
+    await _in_thread(sqlite_conn.close)
+    os.replace(partial, path)
+
+
+def _create_sqlite(path: str) -> sqlite3.Connection:
+    if os.path.exists(path):
+        os.remove(path)  # leftover of an interrupted export
+    sqlite_conn = _connect_sqlite(path)
+    for query in SQLITE_SCHEMA:
+        sqlite_conn.execute(query)
+    sqlite_conn.execute("insert into version values (?)", (TELETHON_SQLITE_CURRENT_VERSION,))
+    return sqlite_conn
+
+
+def _insert(sqlite_conn: sqlite3.Connection, table: str, columns: Sequence[str], rows: Iterable[Tuple]) -> None:
+    sqlite_conn.executemany(
+        f"insert or replace into {table} ({', '.join(columns)}) "
+        f"values ({', '.join('?' * len(columns))})",
+        rows,
+    )
+
+
+async def _bounded(jobs: Iterable[Callable[[], Awaitable[T]]], concurrency: int) -> List[T]:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(job: Callable[[], Awaitable[T]]) -> T:
+        async with semaphore:
+            return await job()
+
+    tasks = [asyncio.ensure_future(run(job)) for job in jobs]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        # pool is likely to be closed by the caller, don't leave jobs running on it
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+async def import_sqlite_files(
+    pool: asyncpg.pool.Pool,
+    paths: Iterable[str],
+    concurrency: int = 8,
+    **options: Any
+) -> Dict[str, str]:
+    """
+    Imports many SQLite session files, no more than ``concurrency`` at once.
+    Every file is imported in its own transaction, the first failure is raised
+    once imports still running are cancelled (and rolled back).
+
+    :param options: other ``import_sqlite`` options
+    :return: mapping of path to its session id
+    """
+    paths = list(paths)
+    session_ids = await _bounded(
+        (functools.partial(import_sqlite, pool, path, **options) for path in paths), concurrency
+    )
+    return dict(zip(paths, session_ids))
+
+
+async def export_sqlite_files(
+    pool: asyncpg.pool.Pool,
+    paths: Mapping[str, str],
+    concurrency: int = 8,
+    **options: Any
+) -> None:
+    """
+    Exports many sessions, no more than ``concurrency`` at once.
+
+    :param paths: mapping of session id to path of file to create
+    :param options: other ``export_sqlite`` options
+    """
+    await _bounded(
+        (
+            functools.partial(export_sqlite, pool, session_id, path, **options)
+            for session_id, path in paths.items()
+        ),
+        concurrency,
+    )
@@ -55,3 +55,92 @@ def get_session():
 @pytest.fixture()
 def client(session: Session):
     return TelegramClient(session, 10, "10")
+
+
+class FakeConnection:
+    """
+    Records queries instead of sending them to postgres.
+    """
+
+    def __init__(self):
+        self.queries = []
+        self.listeners = {}
+
+    async def add_listener(self, channel, callback):
+        self.listeners[channel] = callback
+
+    async def remove_listener(self, channel, callback):
+        self.listeners.pop(channel, None)
+
+    def add_termination_listener(self, callback):
+        pass
+
+    def remove_termination_listener(self, callback):
+        pass
+
+    def transaction(self, **options):
+        conn = self
+
+        class Transaction:
+            async def __aenter__(self):
+                conn.queries.append(("begin", ()))
+
+            async def __aexit__(self, exc_type, *args):
+                conn.queries.append(("rollback" if exc_type else "commit", ()))
+
+        return Transaction()
+
+    async def copy_records_to_table(self, table, records, columns):
+        self.queries.extend((f"copy {table}", tuple(record)) for record in records)
+
+    def cursor(self, sql, *args, prefetch=None):
+        conn = self
+
+        class Cursor:
+            async def __aiter__(self):
+                for row in await conn.fetch(sql, *args):
+                    yield row
+
+        return Cursor()
+
+    async def executemany(self, sql, args):
+        self.queries.extend((sql, tuple(a)) for a in args)
+
+    async def fetch(self, sql, *args):
+        self.queries.append((sql, args))
+        return []
+
+    fetchrow = fetchval = execute = fetch
+
+
+class FakePool:
+    def __init__(self):
+        self.conn = FakeConnection()
+        self.acquired = self.released = 0
+
+    def acquire(self):
+        pool = self
+
+        class Acquire:
+            async def __aenter__(self):
+                pool.acquired += 1
+                return pool.conn
+
+            async def __aexit__(self, *args):
+                pass
+
+            def __await__(self):
+                return self.__aenter__().__await__()
+
+        return Acquire()
+
+    async def release(self, conn):
+        self.released += 1
+
+    def is_closing(self):
+        return False
+
+
+@pytest.fixture()
+def pool():
+    return FakePool()
@@ -0,0 +1,281 @@
+import asyncio
+import base64
+import datetime
+import struct
+import threading
+
+import pytest
+
+from telethon.tl import types
+
+from telethon_asyncpg.sessions import AsyncpgSession
+from telethon_asyncpg.sessions.asyncpg import file_hint
+
+
+@pytest.mark.asyncio
+async def test_session_setters_are_written_once_on_save(pool):
+    session = AsyncpgSession.with_pool(pool, lambda: "s", session_flush_delay=None)
+
+    await session.set_dc(2, "127.0.0.1", 443)
+    await session.set_auth_key(b"k" * 256)
+    await session.set_takeout_id(None)
+    assert pool.acquired == 0
+
+    await session.save()
+    await session.save()
+    assert [args for _, args in pool.conn.queries] == [("s", 2, "127.0.0.1", 443, b"k" * 256, None)]
+
+
+def _state(pts, ts=0):
+    return types.updates.State(
+        pts, 0, datetime.datetime.fromtimestamp(ts, tz=datetime.timezone.utc), 0, 0
+    )
+
+
+@pytest.mark.asyncio
+async def test_update_states_only_move_forward_and_are_batched(pool):
+    session = AsyncpgSession.with_pool(pool, lambda: "s")
+
+    await session.set_update_states({0: _state(10), 1234: _state(5)})
+    await session.set_update_state(1234, _state(3))
+    await session.set_update_state(0, _state(10, ts=60))
+    assert pool.acquired == 0
+    assert (await session.get_update_state(1234)).pts == 5
+
+    await session.save()
+    assert pool.acquired == 1
+    assert sorted(args for _, args in pool.conn.queries) == [
+        ("s", 0, 10, 0, 60, 0), ("s", 1234, 5, 0, 0, 0)
+    ]
+
+    await session.save()
+    assert pool.acquired == 1
+
+
+@pytest.mark.asyncio
+async def test_all_update_states_are_loaded_with_one_query(pool):
+    async def fetch(sql, *args):
+        pool.conn.queries.append((sql, args))
+        return [(0, 10, 0, 0, 0), (1234, 5, 0, 0, 0)]
+
+    pool.conn.fetch = fetch
+    session = AsyncpgSession.with_pool(pool, lambda: "s")
+
+    states = await session.get_all_update_states()
+    assert {entity_id: state.pts for entity_id, state in states.items()} == {0: 10, 1234: 5}
+    assert (await session.get_update_state(1234)).pts == 5
+    assert len(pool.conn.queries) == 1
+
+
+@pytest.mark.asyncio
+async def test_transaction_shares_one_connection_and_commits_once(pool):
+    session = AsyncpgSession.with_pool(pool, lambda: "s", session_flush_delay=None)
+
+    async with session.transaction():
+        await session.set_dc(2, "127.0.0.1", 443)
+        await session.set_update_state(0, _state(10))
+        async with session.transaction():
+            await session.set_auth_key(None)
+        assert pool.conn.queries == []  # nothing is sent before the first statement
+
+    assert pool.acquired == 1
+    queries = [sql for sql, _ in pool.conn.queries]
+    assert queries[0] == "begin" and queries[-1] == "commit"
+    assert len(queries) == 4  # session row, update state, commit
+
+
+@pytest.mark.asyncio
+async def test_transaction_writes_lone_session_row_without_begin(pool):
+    session = AsyncpgSession.with_pool(pool, lambda: "s", session_flush_delay=None)
+
+    async with session.transaction():
+        await session.set_dc(2, "127.0.0.1", 443)
+        await session.set_auth_key(None)
+
+    assert [args for _, args in pool.conn.queries] == [("s", 2, "127.0.0.1", 443, b"", None)]
+    assert pool.acquired == 1
+
+
+@pytest.mark.asyncio
+async def test_transaction_rolls_back_on_error(pool):
+    session = AsyncpgSession.with_pool(pool, lambda: "s", session_flush_delay=None)
+
+    with pytest.raises(ValueError):
+        async with session.transaction():
+            await session.set_dc(2, "127.0.0.1", 443)
+            await session.get_update_state(1)
+            raise ValueError
+
+    assert [sql for sql, _ in pool.conn.queries][::2] == ["begin", "rollback"]
+    await session.save()
+    assert pool.acquired == 2  # change is still pending and written by save
+
+
+@pytest.mark.asyncio
+async def test_failed_commit_keeps_changes_pending(pool):
+    session = AsyncpgSession.with_pool(pool, lambda: "s", session_flush_delay=None)
+    transaction = pool.conn.transaction
+
+    class CommitFails:
+        async def __aenter__(self):
+            await transaction().__aenter__()
+
+        async def __aexit__(self, *args):
+            raise ConnectionError
+
+    pool.conn.transaction = lambda **options: CommitFails()
+    with pytest.raises(ConnectionError):
+        async with session.transaction():
+            await session.set_dc(2, "127.0.0.1", 443)
+            await session.set_update_state(0, _state(10))
+    del pool.conn.transaction
+
+    pool.conn.queries.clear()
+    await session.save()
+    assert sorted(args for _, args in pool.conn.queries) == [
+        ("s", 0, 10, 0, 0, 0), ("s", 2, "127.0.0.1", 443, b"", None)
+    ]
+
+
+@pytest.mark.asyncio
+async def test_transaction_flushes_entities_after_commit(pool):
+    session = AsyncpgSession.with_pool(pool, lambda: "s")
+
+    async with session.transaction():
+        await session.set_dc(2, "127.0.0.1", 443)
+        await session.process_entities([types.User(id=1, access_hash=10, username="one")])
+        await session.save()
+        assert len(pool.conn.queries) == 2  # begin, session row
+
+    queries = [sql for sql, _ in pool.conn.queries]
+    assert queries[0] == "begin" and queries[2] == "commit"
+    assert [args for _, args in pool.conn.queries[3:]] == [("s", 1, 10, "one", None, None)]
+    assert pool.acquired == 2
+
+
+@pytest.mark.asyncio
+async def test_entities_are_iterated_by_cursor_after_flush(pool):
+    session = AsyncpgSession.with_pool(pool, lambda: "s")
+    await session.process_entities([types.User(id=1, access_hash=10, username="one")])
+
+    async def fetch(sql, *args):
+        pool.conn.queries.append((sql, args))
+        return [(1, 10, "one", None, "one"), (2, 20, None, None, "two")]
+
+    pool.conn.fetch = fetch
+    rows = [row async for row in session.iter_entities(batch_size=1)]
+
+    assert rows == [(1, 10, "one", None, "one"), (2, 20, None, None, "two")]
+    assert len(session._entity_buffer) == 0
+    assert [sql for sql, _ in pool.conn.queries][-3:] == [
+        "begin", session._statements.sql("entities_iter"), "commit"
+    ]
+
+
+@pytest.mark.asyncio
+async def test_sessions_are_listed_once(pool):
+    async def fetch(sql, *args):
+        pool.conn.queries.append((sql, args))
+        return [("a",), ("b",)]
+
+    pool.conn.fetch = fetch
+    session = AsyncpgSession.with_pool(pool, lambda: "a")
+
+    assert [session_id async for session_id in session.iter_sessions()] == ["a", "b"]
+    assert "distinct session_id" in pool.conn.queries[1][0]
+    # abstract classmethod is kept intact
+    assert await AsyncpgSession.list_sessions() == []
+
+
+@pytest.mark.asyncio
+async def test_huge_results_are_extracted_in_executor(pool):
+    threads = []
+
+    class Session(AsyncpgSession):
+        def _entities_to_rows(self, tlo):
+            threads.append(threading.get_ident())
+            return super()._entities_to_rows(tlo)
+
+    session = Session.with_pool(pool, lambda: "s", entity_offload_threshold=2)
+    await session.process_entities([types.User(id=1, access_hash=1)])
+    await session.process_entities([types.User(id=2, access_hash=2), types.User(id=3, access_hash=3)])
+
+    assert threads[0] == threading.get_ident() != threads[1]
+    assert len(session._entity_buffer) == 3
+
+
+@pytest.mark.asyncio
+async def test_results_are_not_held_up_nor_overridden_by_extraction_in_executor(pool):
+    extracting = threading.Event()
+    release = threading.Event()
+
+    class Session(AsyncpgSession):
+        def _entities_to_rows(self, tlo):
+            if len(tlo) > 1:
+                extracting.set()
+                release.wait(5)
+            return super()._entities_to_rows(tlo)
+
+    session = Session.with_pool(pool, lambda: "s", entity_offload_threshold=2)
+    huge = asyncio.ensure_future(session.process_entities(
+        [types.User(id=1, access_hash=1), types.User(id=2, access_hash=2)]
+    ))
+    await asyncio.get_event_loop().run_in_executor(None, extracting.wait, 5)
+
+    # newer result is buffered while the older one is still extracted
+    await session.process_entities([types.User(id=2, access_hash=20)])
+    assert session._entity_buffer.get("s", 2).hash == 20
+
+    release.set()
+    await huge
+    assert session._entity_buffer.get("s", 1).hash == 1
+    assert session._entity_buffer.get("s", 2).hash == 20
+    assert await session.get_entity_rows_by_id(2) == [(2, 20)]
+    assert session._offloads == {}
+
+
+@pytest.mark.asyncio
+async def test_sent_files_are_answered_from_index(pool):
+    async def fetch(sql, *args):
+        pool.conn.queries.append((sql, args))
+        return [(b"\x01", 10, 0, 5, 6)] if "sent_files" in sql else []
+
+    pool.conn.fetch = fetch
+    session = AsyncpgSession.with_pool(pool, lambda: "s", file_cache_size=2)
+
+    await session._load_files()
+    assert pool.conn.queries[-1][1] == ("s", 2)
+    assert await session.get_file(b"\x01", 10, types.InputDocument) == types.InputDocument(5, 6, b"")
+
+    await session.cache_file(b"\x02", 20, types.InputPhoto(7, 8, b""))
+    acquired = pool.acquired
+    assert await session.get_file(b"\x02", 20, types.InputPhoto) == types.InputPhoto(7, 8, b"")
+    assert await session.get_file(b"\x01", 10, types.InputDocument) is not None
+    assert pool.acquired == acquired
+
+
+@pytest.mark.asyncio
+async def test_shared_files_record_holders(pool):
+    session = AsyncpgSession.with_pool(pool, lambda: "s", share_files=True)
+    document = types.InputDocument(5, 6, b"")
+
+    await session.cache_file(b"\x01", 10, document)
+    shared = [args for sql, args in pool.conn.queries if "shared_files" in sql]
+    assert shared == [(b"\x01", 10, 0, file_hint(document), "s")]
+    assert base64.urlsafe_b64decode(file_hint(document) + "==") == struct.pack("<Bqq", 0, 5, 6)
+
+    async def fetch(sql, *args):
+        return 1, "hint", ["other", "s"]
+
+    pool.conn.fetchrow = fetch
+    assert await session.get_shared_file(b"\x01", 10) == (types.InputPhoto, "hint", ("other", "s"))
+
+    await session.delete()
+    assert "array_remove" in pool.conn.queries[-2][0]
+
+
+def test_pgbouncer_mode_does_not_change_passed_config():
+    conf = {"dsn": "postgres://"}
+    session = AsyncpgSession(conf, pgbouncer=True)
+    assert conf == {"dsn": "postgres://"}
+    assert session._conf["statement_cache_size"] == 0
@@ -0,0 +1,41 @@
+from telethon_asyncpg.sessions.buffers import EntityBuffer
+
+
+def test_entity_buffer_merges_by_session_and_id():
+    buffer = EntityBuffer(max_size=10, max_delay=60)
+    buffer.add([("s", 1, 10, "old", None, "Old")])
+    buffer.add([("s", 1, 11, "new", None, "New"), ("z", 1, 12, None, None, None)])
+
+    assert len(buffer) == 2
+    assert buffer.find("s", "username", "new") == [(1, 11)]
+    assert buffer.find("s", "id", 1) == [(1, 11)]
+    assert buffer.find("s", "username", "old") == []
+
+
+def test_entity_buffer_flush_thresholds():
+    buffer = EntityBuffer(max_size=2, max_delay=60)
+    assert not buffer.should_flush()
+
+    buffer.add([("s", 1, 10, None, None, None)])
+    assert not buffer.should_flush()
+
+    buffer.add([("s", 2, 10, None, None, None)])
+    assert buffer.should_flush()
+
+    buffer.max_delay = 0
+    rows = buffer.drain()
+    assert len(rows) == 2 and not buffer
+
+    buffer.add([("s", 3, 10, None, None, None)])
+    assert buffer.should_flush()
+
+
+def test_entity_buffer_restore_keeps_newer_rows():
+    buffer = EntityBuffer()
+    buffer.add([("s", 1, 10, "a", None, None)])
+    failed = buffer.drain()
+
+    buffer.add([("s", 1, 11, "b", None, None)])
+    buffer.restore(failed)
+
+    assert buffer.find("s", "id", 1) == [(1, 11)]
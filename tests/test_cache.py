@@ -0,0 +1,72 @@
+import pytest
+
+from telethon.tl import types
+
+from telethon_asyncpg.sessions import AsyncpgSession
+from telethon_asyncpg.sessions.cache import LRUCache
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(maxsize=2)
+    cache.set(1, "a")
+    cache.set(2, "b")
+    assert cache.get(1) == "a"
+
+    cache.set(3, "c")
+    assert 2 not in cache
+    assert cache.get(2) is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+@pytest.mark.asyncio
+async def test_unchanged_entities_are_not_buffered_again():
+    session = AsyncpgSession(None, session_id_factory=lambda: "s")
+    user = types.User(id=1, access_hash=2, username="Someone", first_name="Some")
+
+    await session.process_entities([user])
+    await session.process_entities([user])
+    assert len(session._entity_buffer) == 1
+    assert session.stats["fingerprint_skips"] == 1
+
+    session._entity_buffer.drain()
+    user.username = "other"
+    await session.process_entities([user])
+    assert session._entity_buffer.find("s", "username", "other") == [(1, 2)]
+
+
+@pytest.mark.asyncio
+async def test_entity_cache_answers_without_pool():
+    session = AsyncpgSession(None, session_id_factory=lambda: "s")
+    user = types.User(id=1, access_hash=2, username="Someone", phone="123")
+    await session.process_entities([user])
+    session._entity_buffer.drain()  # pool is None, lookups must not reach it
+
+    assert await session.get_input_entity("someone") == types.InputPeerUser(1, 2)
+    assert await session.get_input_entity("+123") == types.InputPeerUser(1, 2)
+    assert await session.get_input_entity(1) == types.InputPeerUser(1, 2)
+
+
+@pytest.mark.asyncio
+async def test_entity_cache_remembers_misses():
+    session = AsyncpgSession(None, session_id_factory=lambda: "s")
+    calls = []
+
+    async def load():
+        calls.append(1)
+        return []
+
+    assert await session._get_cached_entity_rows("username", "nobody", load) == []
+    assert await session._get_cached_entity_rows("username", "nobody", load) == []
+    assert len(calls) == 1
+
+
+@pytest.mark.asyncio
+async def test_name_miss_is_forgotten_whatever_the_case():
+    session = AsyncpgSession(None, session_id_factory=lambda: "s")
+
+    async def load():
+        return []
+
+    assert await session._get_cached_entity_rows("name", "john smith", load) == []
+    await session.process_entities([types.User(id=1, access_hash=2, first_name="John", last_name="Smith")])
+    assert await session.get_input_entity("john smith") == types.InputPeerUser(1, 2)
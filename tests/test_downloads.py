@@ -0,0 +1,148 @@
+import asyncio
+import logging
+import random
+from collections import defaultdict
+
+import pytest
+
+from telethon.tl import functions, types
+
+from telethon_asyncpg.client.downloads import (
+    DownloadMethods,
+    _DirectDownloadIter,
+    _GenericDownloadIter,
+    _ParallelDownloadIter,
+)
+
+CHUNK = 4096
+
+
+class Session:
+    dc_id = 2
+
+
+class Client:
+    """
+    Answers GetFileRequest from ``data`` after a random delay.
+    """
+
+    download_file = DownloadMethods.download_file
+    iter_download = DownloadMethods.iter_download
+
+    def __init__(self, data):
+        self.data = data
+        self.session = Session()
+        self._sender = object()
+        self._log = defaultdict(lambda: logging.getLogger(__name__))
+        self.requests = []
+        self.in_flight = self.max_in_flight = 0
+
+    async def _call(self, sender, request):
+        assert isinstance(request, functions.upload.GetFileRequest)
+        self.requests.append(request.offset)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(random.random() / 1000)
+        finally:
+            self.in_flight -= 1
+        return types.upload.File(
+            types.storage.FileUnknown(), 0, self.data[request.offset:request.offset + request.limit]
+        )
+
+
+def _download(cls, client, file_size=None, **kwargs):
+    limit = None if file_size is None else (file_size + CHUNK - 1) // CHUNK
+    return cls(
+        client, limit, file=types.InputDocumentFileLocation(1, 2, b"", ""), dc_id=None,
+        offset=0, stride=CHUNK, chunk_size=CHUNK, request_size=CHUNK, file_size=file_size,
+        **kwargs
+    )
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("size", [CHUNK * 20, CHUNK * 20 + 100])
+@pytest.mark.parametrize("known_size", [True, False])
+async def test_parallel_download_is_the_same_as_direct_one(size, known_size):
+    data = bytes(random.getrandbits(8) for _ in range(size))
+    file_size = size if known_size else None
+
+    direct = Client(data)
+    parallel = Client(data)
+    expected = b"".join([chunk async for chunk in _download(_DirectDownloadIter, direct, file_size)])
+    result = b"".join([
+        bytes(chunk) async for chunk in _download(_ParallelDownloadIter, parallel, file_size, parallel=4)
+    ])
+
+    assert expected == result == data
+    assert direct.max_in_flight == 1
+    assert parallel.max_in_flight == 4
+    if known_size:
+        # no request goes past the end
+        assert sorted(parallel.requests) == sorted(direct.requests)[:len(parallel.requests)]
+        assert len(parallel.requests) == (size + CHUNK - 1) // CHUNK
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("file_size", [CHUNK * 3, CHUNK * 3 + 100, CHUNK * 2 + 100])
+async def test_download_file_into_preallocated_file(tmp_path, file_size):
+    data = bytes(random.getrandbits(8) for _ in range(CHUNK * 3 - 10))
+    path = tmp_path / "media" / "file"
+    location = types.InputDocumentFileLocation(1, 2, b"", "")
+    progress = []
+
+    result = await Client(data).download_file(
+        location, str(path), part_size_kb=CHUNK // 1024, file_size=file_size,
+        progress_callback=lambda done, total: progress.append((done, total)),
+    )
+
+    # preallocated file is truncated to what was actually written
+    assert result is None
+    assert path.read_bytes() == data
+    assert progress[-1] == (len(data), file_size)
+    assert await Client(data).download_file(
+        location, bytes, part_size_kb=CHUNK // 1024, file_size=file_size
+    ) == data
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("offset, chunk_size, stride", [
+    (0, 1000, 1000), (100, 1000, 1000), (100, 3000, 7000), (5000, 10000, 10000), (0, 100, 9000),
+])
+async def test_generic_download_does_not_fetch_data_twice(offset, chunk_size, stride):
+    data = bytes(random.getrandbits(8) for _ in range(CHUNK * 10 + 100))
+    client = Client(data)
+
+    chunks = [bytes(chunk) async for chunk in _GenericDownloadIter(
+        client, None, file=types.InputDocumentFileLocation(1, 2, b"", ""), dc_id=None,
+        offset=offset, stride=stride, chunk_size=chunk_size, request_size=CHUNK, file_size=None,
+    )]
+
+    assert chunks == [data[i:i + chunk_size] for i in range(offset, len(data), stride)]
+    assert len(client.requests) == len(set(client.requests))
+    if stride == chunk_size:
+        # every part from the one with the first byte to the last one
+        assert len(client.requests) == len(data) // CHUNK + 1 - offset // CHUNK
+
+
+@pytest.mark.asyncio
+async def test_failed_download_cancels_requests_in_flight():
+    class SlowClient(Client):
+        async def _call(self, sender, request):
+            if request.offset > CHUNK:
+                await asyncio.sleep(60)
+            return await super()._call(sender, request)
+
+    client = SlowClient(bytes(CHUNK * 20))
+
+    def progress(done, total):
+        if done > CHUNK:
+            raise ValueError
+
+    with pytest.raises(ValueError):
+        await client.download_file(
+            types.InputDocumentFileLocation(1, 2, b"", ""), bytes, part_size_kb=CHUNK // 1024,
+            file_size=CHUNK * 20, progress_callback=progress, parallel=4,
+        )
+    await asyncio.sleep(0)
+    assert all(task.done() for task in asyncio.all_tasks() if task is not asyncio.current_task())
@@ -0,0 +1,47 @@
+from telethon.tl import types
+
+ENTITIES = [
+    types.User(1, access_hash=10, first_name="First", last_name="Last", username="UserName", phone="7900"),
+    types.User(2, access_hash=20, last_name="Last"),
+    types.User(3, access_hash=30, is_self=True, first_name="Me"),
+    types.User(4, access_hash=None, first_name="No hash"),
+    types.User(5, access_hash=50, min=True, first_name="Min"),
+    types.UserEmpty(6),
+    types.Chat(7, title="Chat", photo=types.ChatPhotoEmpty(), participants_count=1, date=None, version=1),
+    types.Chat(8, title="", photo=types.ChatPhotoEmpty(), participants_count=1, date=None, version=1),
+    types.ChatForbidden(9, title="Forbidden"),
+    types.ChatEmpty(10),
+    types.Channel(
+        11, title="Channel", photo=types.ChatPhotoEmpty(), date=None, version=0,
+        access_hash=110, username="ChannelName",
+    ),
+    types.Channel(1234567890, title="Big", photo=types.ChatPhotoEmpty(), date=None, version=0, access_hash=1),
+    types.Channel(12, title="Min", photo=types.ChatPhotoEmpty(), date=None, version=0, access_hash=12, min=True),
+    types.ChannelForbidden(13, access_hash=130, title="Forbidden"),
+    types.PeerUser(14),
+    # duplicates, the last usable one wins
+    types.User(1, access_hash=11, first_name="Renamed"),
+    types.User(1, access_hash=12, min=True),
+    types.Chat(7, title="Chat 2", photo=types.ChatPhotoEmpty(), participants_count=1, date=None, version=2),
+]
+
+
+def test_fast_path_gives_the_same_rows_as_generic_one(session):
+    generic = {}
+    for e in ENTITIES:
+        row = session._entity_to_row(e)
+        if row:
+            generic[row[0]] = row
+
+    rows = session._entities_to_rows(ENTITIES)
+    assert len(rows) == len(generic)
+    assert {row[0]: row for row in rows} == generic
+    assert generic[1] == (1, 11, None, None, "Renamed")
+
+
+def test_entities_are_collected_from_result(session):
+    result = types.contacts.ResolvedPeer(
+        peer=types.PeerUser(1), chats=[ENTITIES[6]], users=ENTITIES[:2]
+    )
+    assert sorted(row[0] for row in session._entities_to_rows(result)) == [-7, 1, 2]
+    assert len(session._entities_to_rows(e for e in ENTITIES[:2])) == 2
@@ -0,0 +1,118 @@
+import asyncio
+
+import pytest
+
+from telethon.tl import types
+
+from telethon_asyncpg.sessions import AsyncpgSession, InMemoryL2Cache
+from telethon_asyncpg.sessions.l2cache import encode_command, read_reply, RedisError, RedisL2Cache
+
+
+def test_commands_are_encoded_as_bulk_strings():
+    assert encode_command("SET", "k", b"v", "PX", 1000) == \
+        b"*5\r\n$3\r\nSET\r\n$1\r\nk\r\n$1\r\nv\r\n$2\r\nPX\r\n$4\r\n1000\r\n"
+
+
+@pytest.mark.asyncio
+async def test_replies_are_parsed():
+    reader = asyncio.StreamReader()
+    reader.feed_data(b"+OK\r\n:2\r\n$3\r\na\r\n\r\n$-1\r\n*2\r\n$1\r\nx\r\n:1\r\n-ERR no\r\n")
+    assert await read_reply(reader) == b"OK"
+    assert await read_reply(reader) == 2
+    assert await read_reply(reader) == b"a\r\n"
+    assert await read_reply(reader) is None
+    assert await read_reply(reader) == [b"x", 1]
+    with pytest.raises(RedisError):
+        await read_reply(reader)
+
+
+@pytest.mark.asyncio
+async def test_lookups_are_shared_through_l2_and_invalidated_after_writes(pool):
+    l2 = InMemoryL2Cache()
+    # two processes serving the same session
+    first = AsyncpgSession.with_pool(pool, lambda: "s", l2_cache=l2)
+    second = AsyncpgSession.with_pool(pool, lambda: "s", l2_cache=l2)
+
+    async def fetch(sql, *args):
+        pool.conn.queries.append((sql, args))
+        return [(42, 7)]
+
+    pool.conn.fetch = fetch
+
+    assert await first.get_entity_rows_by_username("durov") == [(42, 7)]
+    assert await second.get_entity_rows_by_username("durov") == [(42, 7)]
+    assert len(pool.conn.queries) == 1
+    assert "s:entity:username:durov" in l2.data
+
+    await second.process_entities(types.contacts.ResolvedPeer(
+        peer=types.PeerUser(42), chats=[],
+        users=[types.User(42, access_hash=8, username="durov")],
+    ))
+    # invalidated once written, peers would load the old row back meanwhile
+    assert "s:entity:username:durov" in l2.data
+    await second.save()
+    assert "s:entity:username:durov" not in l2.data
+    assert "s:entity:id:42" not in l2.data
+
+
+@pytest.mark.asyncio
+async def test_files_are_shared_through_l2_and_invalidated_by_cache_file(pool):
+    l2 = InMemoryL2Cache()
+    session = AsyncpgSession.with_pool(pool, lambda: "s", l2_cache=l2)
+
+    assert await session.get_file(b"\x01", 10, types.InputDocument) is None
+    assert await session.get_file(b"\x01", 10, types.InputDocument) is None
+    assert pool.acquired == 1  # miss is cached as well
+
+    await session.cache_file(b"\x01", 10, types.InputDocument(5, 6, b""))
+    assert l2.data == {}
+
+
+async def _serve(reply):
+    # server answering every command with reply(command), or not at all for None
+    async def handle(reader, writer):
+        try:
+            while True:
+                command = await read_reply(reader)
+                answer = reply(command)
+                if answer is not None:
+                    writer.write(answer)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+
+    return await asyncio.start_server(handle, "127.0.0.1", 0)
+
+
+@pytest.mark.asyncio
+async def test_connection_is_dropped_if_select_fails():
+    replies = [b"-ERR DB index is out of range\r\n", b"+OK\r\n", b"$1\r\nv\r\n"]
+    commands = []
+
+    def reply(command):
+        commands.append(command[0])
+        return replies.pop(0)
+
+    server = await _serve(reply)
+    cache = RedisL2Cache(*server.sockets[0].getsockname()[:2], db=3)
+    with pytest.raises(RedisError):
+        await cache.get("k")
+    assert cache._writer is None
+
+    assert await cache.get("k") == b"v"
+    assert commands == [b"SELECT", b"SELECT", b"GET"]
+    await cache.close()
+    server.close()
+
+
+@pytest.mark.asyncio
+async def test_stalled_server_is_a_cache_miss(pool):
+    server = await _serve(lambda command: None)
+    cache = RedisL2Cache(*server.sockets[0].getsockname()[:2], timeout=0.05)
+    with pytest.raises(asyncio.TimeoutError):
+        await cache.get("k")
+    assert cache._writer is None
+
+    session = AsyncpgSession.with_pool(pool, lambda: "s", l2_cache=cache)
+    assert await session._l2_get("k") is None
+    await cache.close()
+    server.close()
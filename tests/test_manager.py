@@ -0,0 +1,60 @@
+import datetime
+
+import pytest
+
+from telethon.tl import types
+
+from telethon_asyncpg.sessions import SessionManager
+
+
+@pytest.mark.asyncio
+async def test_sessions_share_one_entity_buffer():
+    manager = SessionManager("postgres://")
+    manager._pool = object()  # started manager, pool is never touched here
+
+    first, second = manager.session("first"), manager.session("second")
+    assert manager.session("first") is first
+
+    await first.process_entities([types.User(id=1, access_hash=1)])
+    await second.process_entities([types.User(id=1, access_hash=2)])
+
+    assert len(manager._entity_buffer) == 2
+    assert first._pool is second._pool
+    assert not first._owns_pool and first._schema_ready
+
+
+@pytest.mark.asyncio
+async def test_delete_keeps_entities_of_other_sessions(pool):
+    manager = SessionManager("postgres://")
+    manager._pool = pool
+
+    first, second = manager.session("first"), manager.session("second")
+    await first.process_entities([types.User(id=1, access_hash=1)])
+    await second.process_entities([types.User(id=2, access_hash=2)])
+    await second.delete()
+
+    assert len(manager._entity_buffer) == 1
+    assert manager._entity_buffer.get("first", 1) is not None
+
+@pytest.mark.asyncio
+async def test_close_saves_every_session(pool):
+    closed = []
+
+    async def close():
+        closed.append(True)
+
+    pool.close = close
+    manager = SessionManager("postgres://", session_flush_delay=None)
+    manager._pool = pool
+
+    session = manager.session("first")
+    await session.set_dc(2, "127.0.0.1", 443)
+    await session.set_update_state(0, types.updates.State(
+        10, 0, datetime.datetime.fromtimestamp(0, tz=datetime.timezone.utc), 0, 0
+    ))
+    await session.process_entities([types.User(id=1, access_hash=1)])
+    await manager.close()
+
+    # update state, entity, session row
+    assert sorted(args[:2] for _, args in pool.conn.queries) == [("first", 0), ("first", 1), ("first", 2)]
+    assert closed
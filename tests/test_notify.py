@@ -0,0 +1,92 @@
+import json
+
+import pytest
+
+from telethon_asyncpg.sessions import AsyncpgSession
+from telethon_asyncpg.sessions.asyncpg import _NOT_FOUND
+from telethon_asyncpg.sessions.notify import ORIGIN, _listeners, close_listener, make_payload
+
+
+def _peer_payload(session_id, kind, **fields):
+    return json.dumps({"s": session_id, "k": kind, "o": "peer", **fields})
+
+
+@pytest.mark.asyncio
+async def test_sessions_share_one_listener_and_forget_entities_written_by_peer(pool):
+    first = AsyncpgSession.with_pool(pool, lambda: "s", notify_channel="telethon")
+    other = AsyncpgSession.with_pool(pool, lambda: "other", notify_channel="telethon")
+    await first._listen()
+    await other._listen()
+    assert first._listener is other._listener
+    listen = pool.conn.listeners["telethon"]
+
+    first._entity_cache.set(("id", 1), (1, 10))
+    first._entity_cache.set(("username", "one"), (1, 10))
+    first._entity_cache.set(("username", "two"), (2, 20))
+    first._entity_cache.set(("username", "nobody"), _NOT_FOUND)
+    first._fingerprints.set(1, 123)
+
+    # own notifications are skipped
+    listen(pool.conn, 1, "telethon", make_payload("s", "entities", ids=[1]))
+    assert ("id", 1) in first._entity_cache
+
+    listen(pool.conn, 1, "telethon", _peer_payload("s", "entities", ids=[1]))
+    assert sorted(key for key in first._entity_cache._data) == [("username", "two")]
+    assert 1 not in first._fingerprints
+
+    other._entity_cache.set(("id", 5), (5, 50))
+    listen(pool.conn, 1, "telethon", _peer_payload("other", "delete"))
+    assert len(other._entity_cache) == 0
+
+    await first.close()
+    await other.close()
+    assert "telethon" not in pool.conn.listeners
+    await close_listener(pool)
+
+
+@pytest.mark.asyncio
+async def test_writes_notify_peers(pool):
+    session = AsyncpgSession.with_pool(
+        pool, lambda: "s", notify_channel="telethon", session_flush_delay=None
+    )
+
+    await session.set_dc(2, "127.0.0.1", 443)
+    await session.save()
+    await session.delete()
+
+    notifications = [
+        json.loads(args[1]) for sql, args in pool.conn.queries if "pg_notify" in sql
+    ]
+    assert notifications == [
+        {"s": "s", "k": "session", "o": ORIGIN, "dc": 2},
+        {"s": "s", "k": "delete", "o": ORIGIN},
+    ]
+
+
+@pytest.mark.asyncio
+async def test_close_listener_detaches_channels_before_release(pool):
+    session = AsyncpgSession.with_pool(pool, lambda: "s", notify_channel="telethon")
+    await session._listen()
+    assert "telethon" in pool.conn.listeners
+
+    # pool is closed with sessions still subscribed
+    await close_listener(pool)
+    assert pool.conn.listeners == {}
+
+
+@pytest.mark.asyncio
+async def test_last_session_of_shared_pool_releases_listener(pool):
+    session = AsyncpgSession.with_pool(pool, lambda: "s", notify_channel="telethon")
+    await session._listen()
+    listener = session._listener
+    assert pool.acquired == 1
+
+    await session.close()
+    assert pool.released == 1
+    assert id(pool) not in _listeners
+
+    # listener which is still referenced connects again
+    await listener.subscribe("telethon", "other", lambda message: None)
+    assert _listeners[id(pool)] is listener and pool.acquired == 2
+    await close_listener(pool)
+    assert pool.released == 2
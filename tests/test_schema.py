@@ -0,0 +1,138 @@
+import pytest
+
+from telethon_asyncpg.sessions import asyncpg as asyncpg_session
+
+
+class Pool:
+    closing = False
+
+    def is_closing(self):
+        return self.closing
+
+
+INDEXES = [
+    query.name
+    for _, queries in asyncpg_session.MIGRATIONS for query in queries
+    if isinstance(query, asyncpg_session.ConcurrentIndex)
+]
+
+
+class Connection:
+    def __init__(self, version, indexes=(), locked=False):
+        self.version = version
+        self.indexes = list(indexes)
+        self.locked = locked
+        self.executed = []
+        self.in_transaction = False
+
+    def transaction(self):
+        conn = self
+
+        class Transaction:
+            async def __aenter__(self):
+                conn.in_transaction = True
+
+            async def __aexit__(self, *args):
+                conn.in_transaction = False
+
+        return Transaction()
+
+    async def fetchval(self, query, *args):
+        if "to_regclass" in query:
+            return self.version is not None
+        if "pg_index" in query:
+            return self.indexes
+        if "pg_try_advisory" in query:
+            return not self.locked
+        if "relkind" in query:
+            return True
+        return self.version
+
+    async def execute(self, query, *args):
+        self.executed.append(query)
+        if query.startswith("insert into asyncpg_telethon.version"):
+            self.version = args[0]
+        if query.startswith("create index concurrently"):
+            assert not self.in_transaction
+            self.indexes.append(query.split()[6])
+        elif query.startswith("create index"):
+            assert self.in_transaction
+            self.indexes.append(query.split()[5])
+
+
+@pytest.mark.asyncio
+async def test_migrations_are_applied_once_per_pool():
+    pool, conn = Pool(), Connection(version=None)
+    try:
+        await asyncpg_session.ensure_schema(pool, conn)
+        assert conn.version == asyncpg_session.SCHEMA_VERSION
+        assert conn.executed[0] == "select pg_advisory_xact_lock($1);"
+
+        conn.executed.clear()
+        await asyncpg_session.ensure_schema(pool, conn)
+        assert conn.executed == []
+    finally:
+        asyncpg_session.forget_pool(pool)
+
+
+@pytest.mark.asyncio
+async def test_current_schema_is_not_migrated():
+    pool, conn = Pool(), Connection(version=asyncpg_session.SCHEMA_VERSION, indexes=INDEXES)
+    try:
+        await asyncpg_session.ensure_schema(pool, conn)
+        assert conn.executed == []
+    finally:
+        asyncpg_session.forget_pool(pool)
+
+
+@pytest.mark.asyncio
+async def test_missing_indexes_are_built_concurrently_by_one_process():
+    conn = Connection(version=asyncpg_session.SCHEMA_VERSION, indexes=INDEXES[1:], locked=True)
+    # another process is building them, don't wait for it
+    await asyncpg_session.build_indexes(conn)
+    assert conn.executed == []
+
+    conn.locked = False
+    await asyncpg_session.build_indexes(conn)
+    assert conn.executed[:2] == [
+        f'drop index concurrently if exists "asyncpg_telethon".{INDEXES[0]};',
+        asyncpg_session.MIGRATIONS[1][1][0].query(),
+    ]
+    assert conn.executed[-1] == "select pg_advisory_unlock($1);"
+    assert sorted(conn.indexes) == sorted(INDEXES)
+
+
+@pytest.mark.asyncio
+async def test_indexes_are_built_in_one_transaction_behind_pgbouncer():
+    conn = Connection(version=asyncpg_session.SCHEMA_VERSION, indexes=INDEXES[1:])
+    await asyncpg_session.build_indexes(conn, pgbouncer=True)
+
+    # transaction level lock is released by commit, on the same server connection
+    assert conn.executed == [
+        f'drop index if exists "asyncpg_telethon".{INDEXES[0]};',
+        asyncpg_session.MIGRATIONS[1][1][0].query(concurrently=False),
+    ]
+    assert sorted(conn.indexes) == sorted(INDEXES)
+
+
+def test_partitioned_entities_layout():
+    base = dict(asyncpg_session.MIGRATIONS)[asyncpg_session.TELETHON_SQLITE_CURRENT_VERSION]
+
+    plain = list(asyncpg_session.migration_statements(base))
+    assert not any("partition" in query for query in plain)
+
+    partitioned = list(asyncpg_session.migration_statements(base, partitions=4))
+    assert len(partitioned) == len(plain) + 4
+    assert any("partition by hash (session_id)" in query for query in partitioned)
+    assert "for values with (modulus 4, remainder 3)" in partitioned[-3]
+
+
+@pytest.mark.asyncio
+async def test_closed_pools_are_forgotten():
+    pool, conn = Pool(), Connection(version=asyncpg_session.SCHEMA_VERSION, indexes=INDEXES)
+    await asyncpg_session.ensure_schema(pool, conn)
+    assert asyncpg_session._current_schema_pools[id(pool)] is pool
+
+    pool.closing = True
+    asyncpg_session.forget_pool()
+    assert id(pool) not in asyncpg_session._current_schema_pools
@@ -0,0 +1,47 @@
+import pytest
+
+from telethon_asyncpg.sessions.statements import StatementRegistry
+
+
+class Connection:
+    """
+    Runs queries by their SQL, as asyncpg connection does with its statement cache.
+    """
+
+    def __init__(self):
+        self.queries = []
+        self._pool_release_ctr = 0
+
+    def release(self):
+        self._pool_release_ctr += 1
+
+    async def fetch(self, sql, *args):
+        self.queries.append((sql, args))
+        return [(sql, args)]
+
+    async def executemany(self, sql, args):
+        self.queries.extend((sql, tuple(a)) for a in args)
+
+
+@pytest.mark.asyncio
+async def test_statements_are_run_by_sql_and_timed():
+    registry = StatementRegistry({"one": "select $1", "two": "select 2"})
+    conn = Connection()
+
+    assert await registry.fetch(conn, "one", 1) == [("select $1", (1,))]
+    await registry.executemany(conn, "two", [(), ()])
+    assert conn.queries == [("select $1", (1,)), ("select 2", ()), ("select 2", ())]
+    assert registry.stats["one"]["calls"] == 1
+    assert registry.stats["two"]["calls"] == 1
+
+
+@pytest.mark.asyncio
+async def test_statements_outlive_release_to_the_pool():
+    registry = StatementRegistry({"one": "select $1"})
+    conn = Connection()
+
+    # registry keeps no connection resources, which are invalidated by release
+    for n in range(3):
+        conn.release()
+        assert await registry.fetch(conn, "one", n) == [("select $1", (n,))]
+    assert registry.stats["one"]["calls"] == 3
@@ -0,0 +1,111 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+from telethon_asyncpg.sessions.asyncpg import _current_schema_pools
+from telethon_asyncpg.sessions.transfer import (
+    SQLITE_SCHEMA,
+    _bounded,
+    export_sqlite,
+    import_sqlite_files,
+)
+
+TABLES = {
+    "sessions": [(2, "149.154.167.51", 443, b"k" * 256, None)],
+    "entities": [(1, 10, "one", "79000000001", "One"), (2, 20, None, None, "Two")],
+    "sent_files": [(b"\x01" * 16, 100, 0, 5, 6)],
+    "update_state": [(0, 10, 1, 1600000000, 3)],
+}
+
+
+def _make_session_file(path):
+    conn = sqlite3.connect(str(path))
+    for query in SQLITE_SCHEMA:
+        conn.execute(query)
+    conn.execute("insert into version values (6)")
+    for table, rows in TABLES.items():
+        for row in rows:
+            conn.execute(f"insert into {table} values ({', '.join('?' * len(row))})", row)
+    conn.commit()
+    conn.close()
+
+
+def _copied(pool, table):
+    return [args for sql, args in pool.conn.queries if sql == f"copy _stage_{table}"]
+
+
+@pytest.mark.asyncio
+async def test_sqlite_files_are_copied_and_exported_back(pool, tmp_path):
+    _current_schema_pools[id(pool)] = pool
+    for name in ("a", "b"):
+        _make_session_file(tmp_path / f"{name}.session")
+
+    imported = await import_sqlite_files(
+        pool, [str(tmp_path / "a.session"), str(tmp_path / "b.session")], concurrency=1
+    )
+    assert list(imported.values()) == ["a", "b"]
+    assert _copied(pool, "entities")[:2] == [
+        ("a", 1, 10, "one", 79000000001, "One"), ("a", 2, 20, None, None, "Two")
+    ]
+    assert _copied(pool, "sent_files")[0] == ("a", b"\x01" * 16, 100, 0, 5, 6)
+
+    stored = {
+        table: [row[1:] for row in _copied(pool, table) if row[0] == "a"]
+        for table in ("entities", "sent_files", "update_state")
+    }
+    stored["sessions"] = [
+        args[1:] for sql, args in pool.conn.queries if "sessions" in sql and args[0] == "a"
+    ]
+
+    async def fetch(sql, *args):
+        table = sql.split("asyncpg_telethon.")[1].split()[0]
+        return stored[table]
+
+    pool.conn.fetch = fetch
+    await export_sqlite(pool, "a", str(tmp_path / "exported.session"), batch_size=1)
+
+    conn = sqlite3.connect(str(tmp_path / "exported.session"))
+    assert conn.execute("select version from version").fetchall() == [(6,)]
+    assert conn.execute("select * from entities order by id").fetchall() == [
+        (1, 10, "one", 79000000001, "One"), (2, 20, None, None, "Two")
+    ]
+    assert conn.execute("select * from sessions").fetchall() == TABLES["sessions"]
+    assert conn.execute("select * from update_state").fetchall() == TABLES["update_state"]
+    conn.close()
+    _current_schema_pools.pop(id(pool))
+
+
+@pytest.mark.asyncio
+async def test_old_sqlite_files_are_refused(pool, tmp_path):
+    _current_schema_pools[id(pool)] = pool
+    path = tmp_path / "old.session"
+    conn = sqlite3.connect(str(path))
+    conn.execute("create table version (version integer primary key)")
+    conn.execute("insert into version values (5)")
+    conn.commit()
+    conn.close()
+
+    with pytest.raises(ValueError):
+        await import_sqlite_files(pool, [str(path)])
+    _current_schema_pools.pop(id(pool))
+
+
+@pytest.mark.asyncio
+async def test_running_jobs_are_cancelled_on_first_failure():
+    cancelled = []
+
+    async def slow():
+        try:
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    async def fails():
+        raise ValueError
+
+    with pytest.raises(ValueError):
+        await _bounded([slow, fails, slow], concurrency=2)
+    # the last one has taken the slot of the failed one
+    assert cancelled == [True, True]
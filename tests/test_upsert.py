@@ -0,0 +1,22 @@
+from telethon_asyncpg.sessions.asyncpg import UPSERTS, EntityRow, UpdateStateRow
+
+
+def test_upsert_query_updates_non_key_columns():
+    query = UPSERTS["sent_files"].query
+
+    assert "values ($1, $2, $3, $4, $5, $6)" in query
+    assert "on conflict(session_id, md5_digest, file_size, type)" in query
+    assert "id = excluded.id, hash = excluded.hash;" in query
+
+
+def test_staged_upsert_query_deduplicates_keys():
+    query = UPSERTS["entities"].staged_query
+
+    assert "from _stage_entities" in query
+    assert "select distinct on (session_id, id)" in query
+    assert "on conflict(session_id, id) do update set hash = excluded.hash" in query
+
+
+def test_row_types_are_in_upsert_parameter_order():
+    assert EntityRow._fields == UPSERTS["entities"].columns
+    assert UpdateStateRow._fields == UPSERTS["update_state"].columns